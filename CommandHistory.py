@@ -1,104 +1,148 @@
-import re
-from common import fuzzy_match
+import os, time
+import itertools, threading
+from HistorySearch import HistorySearch, required_substrings
+from HistoryIndex import HistoryIndex
+from HistoryStore import HistoryStore
+from HistoryRanking import HistoryRanking
+from HistoryTimeline import HistoryTimeline
+from HistoryWords import HistoryWords
 
 class CommandHistory:
     """
     Handle all things related to managing and navigating the command history
     """
+
+    # Maintain a trigram index over the history so that searches only need to
+    # scan the lines containing the filter words
+    use_index = True
+
     def __init__(self):
-        # The actual command list
-        self.list = []
+        # The actual command list (unique lines, oldest first)
+        self.list = HistoryStore()
+
+        # Trigram index over the command list (None if disabled)
+        self.index = HistoryIndex(self.list) if self.use_index else None
+
+        # Index of the command list by time, for the history queries
+        self.timeline = HistoryTimeline(self.list)
+
+        # Index of the words in the command list, for expanding words
+        self.words = HistoryWords()
+
+        # How to order the matches within a tier: by 'recency' or by
+        # 'frecency' (the ranking is only built when first needed)
+        self.ranking_mode = 'recency'
+        self.ranking = None
+
+        # Show the matches among the commands last run in the current
+        # directory before the ones run elsewhere
+        self.dir_first = True
 
         # The current search filter
         self.filter = ''
 
-        # A filtered list based on the current filter
+        # The matches for the current filter, generated as we navigate, and
+        # the ones we already got but navigated back from (the next one last)
+        self.matches = iter(())
         self.filtered_list = []
 
+        # The last search (one per group of lines, see search_groups) and the
+        # directory it was done in, kept to incrementally narrow it down as
+        # the filter grows
+        self.searches = None
+        self.search_dir = None
+
         # A trail of visited indices (while navigating)
         self.trail = []
 
+        # While loading in the background: the (line, metadata) pairs read so
+        # far (newest first), and the store and indices once they are built
+        self.loading = None
+        self.loaded = None
+        self.loader = None
+
     def start(self, line):
         """
         Start history navigation
         """
         #print '\n\nStart\n\n'
         self.filter = line
+        self.swap_loaded()
 
-        # Create a list of regex patterns to use when navigating the history
-        # using a filter
-        # A. First use just the space as word separator; these are the most
-        # useful matches (think acronyms 'g c m' for 'git checkout master' etc)
-        words = [re.escape(w) for w in re.findall('[^\\s]+', line)] # Split the filter into words
-        boundary = '[\\s]+'
-        patterns = [
-            # Prefixes match for each word in the command (strongest, these will be the
-            # first in the list
-            '^' + boundary.join(['(' + word + ')[^\\s]*' for word in words]) + '$',
-
-            # Prefixes match for some words in the command
-            boundary.join(['(' + word + ')[^\\s]*' for word in words]),
-        ]
-
-        # B. Then split based on other separator characters as well
-        words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)] # Split the filter into words
-        boundary = '[\\s\\.\\-\\\\_]+'   # Word boundary characters
-        patterns += [
-            # Prefixes match for each word in the command (strongest, these will be the
-            # first in the list
-            '^' + boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]) + '$',
-
-            # Prefixes match for some words in the command
-            boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]),
-
-            # Exact string match
-            '(' + re.escape(line) + ')',
-
-            # Substring match in different words
-            boundary.join(['(' + word + ').*' for word in words]),
-
-            # Substring match anywhere (weakest, these will be the last results)
-            ''.join(['(' + word + ').*' for word in words])
-        ]
-
-        if len(words) <= 1:
-            # Optimization: Skip the advanced word-based matching for empty or
-            # simple (one-word) filters -- this saves a lot of computation effort
-            # as these filters will yield a long list of matched lines!
-            patterns = [patterns[4]]
-
-        # Traverse the history and build the filtered list
+        # Narrow down the previous search if the filter just got longer;
+        # otherwise traverse the whole history
+        cwd = os.getcwd()
+        searches = None
+        if self.searches and self.search_dir == cwd:
+            searches = [search.refine(line) for search in self.searches]
+        if not searches or None in searches:
+            if self.loading is not None:
+                # Still loading, search what we have so far
+                searches = [HistorySearch(line, self.newest_first())]
+            else:
+                ids = self.index.lookup(required_substrings(line)) if self.index else None
+                searches = [HistorySearch(line, (self.list.line(id) for id in group))
+                            for group in self.search_groups(ids, cwd)]
+        self.searches = searches
+        self.search_dir = cwd
+
+        # Only look for the first match now, the others are found as up()
+        # needs them
+        self.matches = itertools.chain(*[search.matches() for search in searches])
         self.filtered_list = []
-        for pattern in patterns:
-            #print '\n\n', pattern, '\n\n'
-            for line in reversed(self.list):
-                if line in [l for (l, p) in self.filtered_list]:
-                    # We already added this line, skip
-                    continue
-                # No need to re.compile() this, the re library automatically caches compiled
-                # versions of the recently used expressions
-                matches = re.search(pattern, line, re.IGNORECASE)
-                if matches:
-                    self.filtered_list.insert(0, (line, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
-                    # print '\n\n', self.filtered_list[0], '\n\n'
-
-                    # optimization: limit the results added to filtered_list.
-                    # the filter list is traversed by keyup/keydown so more than tens in the list looks crazy
-                    # The high selective pattern should always be used when necessary.
-                    if len(self.filtered_list) >= 30 :
-                        break;
-            if len(self.filtered_list) >= 30 :
-                break;
+        self.next_match()
 
         # We use the trail to navigate back in the same order
         # don't update self.trail if there is no match in filter
         if self.filtered_list :
             self.trail = [(self.filter, [(0, len(self.filter))])]
 
+    def search_groups(self, ids, dir):
+        """
+        Split the ids of the lines to search (all of them if None, otherwise
+        listed newest first) into groups searched one after the other: the
+        lines last run in the given directory, then the others
+        """
+        dir_id = self.list.dir_index.get(dir.lower()) if self.dir_first else None
+        if dir_id is None:
+            return [self.ranked_ids(ids)]
+        dir_ids = self.list.dir_ids
+        if ids is None:
+            # The per-directory index spares us a scan of the whole history
+            local = self.list.ids_in_dir(dir)
+        else:
+            ids, local = itertools.tee(ids)
+            local = (id for id in local if dir_ids[id] == dir_id)
+        return [self.ranked_ids(local),
+                (id for id in self.ranked_ids(ids) if dir_ids[id] != dir_id)]
+
+    def ranked_ids(self, ids = None):
+        """
+        Return the ids of the lines to search (all of them, or the given ones
+        listed newest first) in the order of the current ranking mode
+        """
+        if self.ranking_mode == 'frecency':
+            if not self.ranking:
+                self.ranking = HistoryRanking(self.list)
+            if ids is None:
+                return self.ranking.ranked_ids(os.getcwd())
+            else:
+                return self.ranking.sort(ids, os.getcwd())
+        else:
+            return self.list.reversed_ids() if ids is None else ids
+
+    def next_match(self):
+        """Get the next match for the current filter into the filtered list"""
+        match = next(self.matches, None)
+        if match:
+            self.filtered_list.append(match)
+
     def up(self):
         """
         Navigate back in the command history
         """
+        if not self.filtered_list:
+            self.next_match()
         if self.filtered_list:
             self.trail.append(self.filtered_list.pop())
             return True
@@ -115,18 +159,146 @@ class CommandHistory:
     def reset(self):
         """Reset browsing through the history"""
         self.filter = ''
+        self.matches = iter(())
         self.filtered_list = []
         self.trail = []
 
-    def add(self, line):
-        """Add a new line to the history"""
+    def load(self, lines, metas = None):
+        """
+        Replace the history with the given lines (oldest first), optionally
+        with their metadata (see HistoryStore.append)
+        """
+        self.list = HistoryStore()
+        for i in range(len(lines)):
+            self.list.append(lines[i], **(metas[i] if metas else {}))
+        if self.index:
+            self.index = HistoryIndex(self.list)
+        self.timeline = HistoryTimeline(self.list)
+        self.words = HistoryWords(self.list)
+        self.ranking = None
+        self.searches = None
+        self.loading = None
+        self.loaded = None
+        self.reset()
+
+    def load_in_background(self, records):
+        """
+        Load the history from an iterable of (line, metadata) pairs, newest
+        first, in a background thread; a line may come several times (once
+        per run), the newest wins
+
+        Until the loading is done, the history is searched linearly through
+        the lines loaded so far. Then the complete history and its index are
+        swapped in at once, on the next search -- or when adding a line, which
+        waits for the loading to finish.
+        """
+        self.load([])
+        self.loading = []
+        self.loaded = None
+        self.loader = threading.Thread(target=self._load, args=(records, self.loading))
+        self.loader.daemon = True
+        self.loader.start()
+
+    def _load(self, records, loading):
+        """Read the records and build the history (in the background thread)"""
+        for record in records:
+            loading.append(record)
+        store = HistoryStore()
+        for (line, meta) in reversed(loading):
+            store.append(line, **meta)
+        index = HistoryIndex(store) if self.index is not None else None
+        self.loaded = (store, index, HistoryTimeline(store), HistoryWords(store))
+
+    def swap_loaded(self, wait = False):
+        """
+        Swap in the history loaded in the background once it is ready (or
+        wait for it)
+        """
+        if self.loading is None:
+            return
+        if wait:
+            self.loader.join()
+        if self.loaded:
+            (self.list, self.index, self.timeline, self.words) = self.loaded
+            self.ranking = None
+            self.searches = None
+            self.loading = None
+            self.loaded = None
+
+    def newest_first(self):
+        """
+        Iterate over the lines in the history, newest first (i.e. the ones
+        loaded so far, if loading in the background)
+        """
+        if self.loading is not None:
+            return unique(line for (line, meta) in self.loading[:])
+        return reversed(self.list)
+
+    def add(self, line, exit_code = None, dir = None, duration = None):
+        """
+        Add a new line to the history, optionally with the exit code of the
+        command, the directory it was run in and how long it took (in seconds)
+        """
         if line:
             #print 'Adding "' + line + '"'
-            if line in self.list:
-                self.list.remove(line)
-            self.list.append(line)
-            self.reset()
+            if duration is not None:
+                duration = round(duration, 3)
+            self.merge([(line, {'time': time.time(), 'exit_code': exit_code,
+                                'duration': duration, 'dir': dir})])
+
+    def merge(self, records):
+        """
+        Add (line, metadata) pairs to the history, oldest first (e.g. the
+        ones recorded by other PyCmd instances)
+        """
+        if not records:
+            return
+        self.swap_loaded(wait=True)
+        for (line, meta) in records:
+            # The previous occurrence of the line (if any) is found by hash
+            # and replaced; its run count carries over unless given
+            removed = self.list.find(line)
+            id = self.list.append(line, **meta)
+            if self.index:
+                if removed is not None:
+                    self.index.remove(removed)
+                self.index.add(id, line)
+            if removed is not None:
+                self.timeline.remove(removed)
+                self.words.remove(line)
+            self.timeline.add(id)
+            self.words.add(line)
+            if self.ranking:
+                self.ranking.update(id, removed)
+        self.searches = None
+        self.reset()
+
+    def expansions(self, stub, context):
+        """
+        Return the words in the history that the given stub can be expanded
+        to, best first (see HistoryWords.expansions)
+        """
+        self.swap_loaded()
+        if self.loading is not None:
+            # Still loading, index what we have so far
+            words = HistoryWords(reversed(list(self.newest_first())))
+        else:
+            words = self.words
+        return words.expansions(stub, context)
+
+    def meta(self, line):
+        """Return the metadata of a line in the history (see HistoryStore.meta)"""
+        return self.list.meta(self.list.find(line))
 
     def current(self):
         """Return the current history item"""
         return self.trail[-1] if self.trail else ('', [])
+
+
+def unique(lines):
+    """Iterate over the lines, skipping the ones seen already"""
+    seen = set()
+    for line in lines:
+        if line not in seen:
+            seen.add(line)
+            yield line
@@ -0,0 +1,80 @@
+import sys, threading
+
+class CompletionCancelled(Exception):
+    """Raised within a completion function when its job is cancelled"""
+    pass
+
+class CompletionJob:
+    """
+    Completion running in a background thread, so that the input loop can
+    report its progress and cancel it (e.g. on a key press) while a huge or
+    slow directory is being listed
+
+    The completion function is called with the line and the job. It passes
+    the job down to the directory listings, which report each match with
+    found() as they go and call check() to stop early once cancelled.
+    """
+
+    # How long a completion can take before its progress is shown (in seconds)
+    progress_delay = 0.3
+
+    def __init__(self, complete, line):
+        # The matches found so far and their longest common prefix (ignoring case)
+        self.matches = []
+        self.common_prefix = None
+
+        # The (completed line, completions) pair once done, or the error raised
+        self.result = None
+        self.error = None
+
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(complete, line))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, timeout = None):
+        """
+        Wait for the completion to finish (up to the timeout, in seconds);
+        return whether it did
+        """
+        return self.done.wait(timeout)
+
+    def cancel(self):
+        """Stop the completion (its result is dropped)"""
+        self.cancelled.set()
+
+    def get(self):
+        """Return the result of the completion, or raise its error"""
+        if self.error:
+            raise self.error[1].with_traceback(self.error[2])
+        return self.result
+
+    def check(self):
+        """Raise CompletionCancelled if the job was cancelled (in the background thread)"""
+        if self.cancelled.is_set():
+            raise CompletionCancelled()
+
+    def found(self, match):
+        """Report a match as soon as it is found (in the background thread)"""
+        self.matches.append(match)
+        common_prefix = self.common_prefix
+        if common_prefix is None:
+            self.common_prefix = match
+            return
+        i = 0
+        while i < len(common_prefix) and i < len(match) and common_prefix[i].lower() == match[i].lower():
+            i += 1
+        if i < len(common_prefix):
+            self.common_prefix = common_prefix[:i]
+
+    def _run(self, complete, line):
+        """Run the completion (in the background thread)"""
+        try:
+            self.result = complete(line, self)
+        except CompletionCancelled:
+            pass
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.done.set()
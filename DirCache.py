@@ -0,0 +1,100 @@
+import os, stat, time, threading
+from collections import OrderedDict
+
+class DirCache:
+    """
+    Cache of the directory listings used for completing file names, so that
+    pressing Tab again in the same directory doesn't list it again
+
+    The entries of a directory are listed with os.scandir, which tells the
+    directories from the files without an extra stat per entry. A listing is
+    reused as long as the modification time of the directory is unchanged
+    (creating, deleting or renaming an entry changes it). Only the most
+    recently used directories are kept.
+
+    The cache is shared by the completion jobs running in the background (a
+    cancelled one may still be waiting for a slow directory), so it is only
+    updated under a lock.
+    """
+
+    # How many directory listings to keep
+    max_dirs = 32
+
+    # Listings taken less than this long after the directory was modified
+    # (in seconds) are not reused, as a change within the same tick of the
+    # file system clock would go unnoticed
+    racy_interval = 2
+
+    def __init__(self):
+        # Directory -> (modification time, whether the listing can be
+        # reused, [(name, is_dir, is_file)]), least recently used first
+        self.dirs = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def entries(self, dir, job = None):
+        """
+        Iterate over the entries of a directory as (name, is_dir, is_file)
+        tuples (none if it can't be listed); while listing it, check whether
+        the given CompletionJob (if any) got cancelled
+        """
+        key = os.path.normcase(os.path.abspath(dir))
+        try:
+            info = os.stat(key)
+        except OSError:
+            with self.mutex:
+                self.dirs.pop(key, None)
+            return []
+        if not stat.S_ISDIR(info.st_mode):
+            return []
+
+        with self.mutex:
+            cached = self.dirs.get(key)
+            if cached and cached[0] == info.st_mtime and cached[1]:
+                self.dirs.move_to_end(key)
+                return cached[2]
+        return self._list(key, info.st_mtime, job)
+
+    def matches(self, dir, matcher, job = None):
+        """
+        Return the names of the directories and of the files in a directory
+        that match a (wildcard) matcher, as two lists; the matches are also
+        reported to the given CompletionJob (if any) as they are found
+        """
+        dirs = []
+        files = []
+        for (name, is_dir, is_file) in self.entries(dir, job):
+            if matcher.match(name):
+                if is_dir:
+                    dirs.append(name)
+                    if job:
+                        job.found(name + '\\')
+                elif is_file:
+                    files.append(name)
+                    if job:
+                        job.found(name)
+        return (dirs, files)
+
+    def _list(self, key, mtime, job):
+        """
+        List a directory, yielding its entries as they are read, and cache
+        the listing once complete
+        """
+        entries = []
+        try:
+            with os.scandir(key) as elems:
+                for elem in elems:
+                    entry = (elem.name, elem.is_dir(), elem.is_file())
+                    entries.append(entry)
+                    yield entry
+                    if job and len(entries) % 256 == 0:
+                        job.check()
+        except OSError:
+            # Cannot complete, probably access denied
+            with self.mutex:
+                self.dirs.pop(key, None)
+            return
+        with self.mutex:
+            self.dirs[key] = (mtime, time.time() - mtime >= self.racy_interval, entries)
+            self.dirs.move_to_end(key)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
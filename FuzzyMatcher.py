@@ -0,0 +1,139 @@
+import re
+
+# Word boundary characters (as in the history search patterns)
+boundary = '[\\s\\.\\-\\\\_]'
+boundary_re = re.compile(boundary)
+
+# Matches at the start of the string or after a boundary character
+at_boundary = '(?<![^\\s\\.\\-\\\\_])'
+
+def lowercase(string):
+    """Lowercase a string, keeping the positions of its characters"""
+    lower = string.lower()
+    if len(lower) != len(string):
+        # Some characters change length when lowercased
+        lower = ''.join([char.lower()[:1] for char in string])
+    return lower
+
+class FuzzyMatcher:
+    """
+    Match a sequence of words (e.g. the words of a search filter) as a
+    subsequence of a string, ignoring case, and score how good the match is
+
+    Each word has to occur in the string as is, after the previous one. Among
+    the possible placements, the matcher prefers the ones where the words
+    start at word boundaries, follow each other directly and match the case
+    of the string. It places the words one by one, within the range that
+    keeps the rest of the words matchable, so a string is matched in a few
+    linear passes rather than by backtracking like a '.*'-joined regex.
+    """
+
+    # Score of each matched character, and the bonuses and penalties of a word
+    score_char = 16
+    bonus_boundary = 8      # The word starts at a word boundary
+    bonus_consecutive = 4   # The word starts right after the previous one
+    bonus_case = 1          # Per character matching the case of the string
+    penalty_gap = 1         # Per character skipped between two words...
+    max_gap_penalty = 16    # ...up to this much
+
+    def __init__(self, words, prefix_only = False):
+        self.words = words
+        self.lower_words = [lowercase(word) for word in words]
+        self.boundary_patterns = [re.compile(at_boundary + re.escape(word))
+                                  for word in self.lower_words]
+
+        # Only match the (non-empty) words at word boundaries
+        self.prefix_only = prefix_only
+
+    def match(self, string):
+        """
+        Return a (score, spans) pair, where spans lists the (start, end) of
+        each word in the string, or None if the string doesn't match
+        """
+        lower = lowercase(string)
+        last = self.bounds(lower)
+        return self.place(string, lower, last) if last is not None else None
+
+    def bounds(self, lower):
+        """
+        Quickly check whether a (lowercase) string matches; return the last
+        position where each word can start so that the following words still
+        fit after it, or None if the string doesn't match
+        """
+        words = self.lower_words
+        last = [0] * len(words)
+        end = len(lower)
+        for i in range(len(words) - 1, -1, -1):
+            if self.prefix_only:
+                end = self._rfind(lower, i, end)
+            else:
+                end = lower.rfind(words[i], 0, end)
+            if end < 0:
+                return None
+            last[i] = end
+        return last
+
+    def place(self, string, lower, last):
+        """
+        Place the words in a matching string (see bounds) and return the
+        (score, spans) pair
+        """
+        # Left to right: place each word at the best position in its range;
+        # that is either its first occurrence (the closest to the previous
+        # word) or its first occurrence at a word boundary
+        words = self.lower_words
+        score = 0
+        spans = []
+        pos = 0
+        for i in range(len(words)):
+            starts = set([self._find(lower, i, pos, last[i]),
+                          self._find(lower, i, pos, last[i], True)])
+            starts.discard(-1)
+            (bonus, start) = max([(self._bonus(string, i, start, pos if spans else None), -start)
+                                  for start in starts])
+            start = -start
+            score += len(words[i]) * self.score_char + bonus
+            spans.append((start, start + len(words[i])))
+            pos = start + len(words[i])
+        return (score, spans)
+
+    def _find(self, lower, i, start, last, at_boundary = False):
+        """
+        Find the first occurrence of the i-th word starting in [start, last]
+        (only at word boundaries if requested), or -1
+        """
+        word = self.lower_words[i]
+        if word and (at_boundary or self.prefix_only):
+            match = self.boundary_patterns[i].search(lower, start, last + len(word))
+            return match.start() if match else -1
+        return lower.find(word, start, last + len(word))
+
+    def _rfind(self, lower, i, end):
+        """
+        Find the last occurrence of the i-th word at a word boundary and
+        ending before end, or -1
+        """
+        word = self.lower_words[i]
+        while True:
+            start = lower.rfind(word, 0, end)
+            if start <= 0 or not word or boundary_re.match(lower, start - 1):
+                return start
+            end = start + len(word) - 1
+
+    def _bonus(self, string, i, start, previous_end):
+        """
+        Return the bonus (or penalty) for placing the i-th word at the given
+        position, after a word ending at previous_end (None for the first word)
+        """
+        bonus = 0
+        if previous_end is not None:
+            bonus -= min((start - previous_end) * self.penalty_gap, self.max_gap_penalty)
+            if start == previous_end:
+                bonus += self.bonus_consecutive
+        if start == 0 or boundary_re.match(string, start - 1):
+            bonus += self.bonus_boundary
+        word = self.words[i]
+        for j in range(min(len(word), len(string) - start)):
+            if string[start + j] == word[j]:
+                bonus += self.bonus_case
+        return bonus
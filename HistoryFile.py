@@ -0,0 +1,848 @@
+import os, time, datetime, uuid, struct, mmap, hashlib, zlib, shutil
+import contextlib, threading, heapq, math, collections
+try:
+    import msvcrt
+except ImportError:
+    # Not on Windows
+    msvcrt = None
+    import fcntl
+
+# Format of the datetime appended to the lines in the text history files
+tail_datetime_format = "[%Y/%m/%d %I:%M:%S%p %A]"
+
+def append_tail_datetime(line, when = None):
+    """Append a time (in seconds since the epoch, or now) to a line"""
+    stamp = datetime.datetime.now() if when is None else datetime.datetime.fromtimestamp(when)
+    return line + stamp.strftime(tail_datetime_format)
+
+def remove_tail_datetime(line):
+    # empty line slips in by crashing pycmd?
+    if len(line) == 0:
+        return ''
+    if line[-1] == u']':
+        i = len(line) - 4
+        if i > 0 and line[i] == u'd' and line[i+1] == u'a' and line[i+2] == u'y':
+            i -= 26
+            for j in range(4):
+                k = i - j
+                if k > 0:
+                    if line[k] == u'[':
+                        return line[:k]
+                else:
+                    break;
+    # no tail datetime found
+    return line
+
+# Metadata fields that can prefix a line in the command history file, with
+# their parsers; a line with metadata looks like
+#    <Tab>time=1700000000<Tab>count=3<Tab>exit_code=0<Tab>duration=1.25<Tab>dir=C:\src<Tab>seq=1f2e3d4c:7<Tab>command
+# (tabs can't appear in paths or in the typed commands); time is in seconds
+# since the epoch, duration in seconds (to the millisecond), seq tags the
+# record with the PyCmd instance that wrote it (see HistoryFile). Older files
+# have no time field but a tail datetime appended to the line instead.
+history_meta_fields = {'time': int, 'count': int, 'exit_code': int, 'duration': float,
+                       'dir': str, 'seq': str}
+
+def format_history_meta(meta):
+    """Format the metadata of a history line as a prefix for the history file"""
+    fields = [name + '=' + str(history_meta_fields[name](meta[name]))
+              for name in history_meta_fields if meta.get(name) is not None]
+    return '\t' + '\t'.join(fields) + '\t' if fields else ''
+
+def split_history_meta(line):
+    """
+    Split a line from a history file into its metadata (as a dictionary) and
+    the rest of the line
+    """
+    meta = {}
+    start = 1 if line.startswith('\t') else len(line)
+    while True:
+        end = line.find('\t', start)
+        name, equal, value = line[start:end].partition('=')
+        if end < 0 or not equal or name not in history_meta_fields:
+            break
+        try:
+            meta[name] = history_meta_fields[name](value)
+        except ValueError:
+            pass
+        start = end + 1
+    return meta, line[start:] if meta else line
+
+def history_line(record):
+    """Return the line stored in a history file record, without its metadata"""
+    return parse_record(record)[0]
+
+def tail_datetime(line):
+    """Return the time (in seconds since the epoch) in the tail datetime of a line, or None"""
+    stripped = remove_tail_datetime(line)
+    if stripped == line:
+        return None
+    try:
+        stamp = datetime.datetime.strptime(line[len(stripped):], tail_datetime_format)
+    except ValueError:
+        return None
+    return int(time.mktime(stamp.timetuple()))
+
+def parse_record(record):
+    """
+    Parse a record from a text history file into a (line, metadata) pair;
+    for the records of older files, the time comes from the tail datetime
+    """
+    (meta, line) = split_history_meta(record)
+    if 'time' in meta:
+        return (line, meta)
+    stamp = tail_datetime(line)
+    if stamp is not None:
+        meta['time'] = stamp
+    return (remove_tail_datetime(line), meta)
+
+def record_seq(record):
+    """
+    Return the instance id and sequence number in the metadata of a record
+    from a text history file, or None (this spares parsing the whole record)
+    """
+    if not record.startswith('\t'):
+        return None
+    start = record.find('\tseq=')
+    if start < 0:
+        return None
+    end = record.find('\t', start + 1)
+    (instance, colon, number) = record[start + 5 : end].partition(':')
+    try:
+        return (instance, int(number))
+    except ValueError:
+        return None
+
+def format_record(line, meta, legacy = False):
+    """
+    Format a line and its metadata as a record of a text history file (or,
+    if legacy, as in older files: with the time as a tail datetime)
+    """
+    if legacy and meta.get('time') is not None:
+        return append_tail_datetime(format_history_meta(dict(meta, time=None)) + line, meta['time'])
+    return format_history_meta(meta) + line
+
+# Start of the checksum trailer line in the text history files
+checksum_prefix = '\t#crc32='
+
+def convert_history_file(source, target):
+    """
+    Copy all the records of a history file into another one (replacing it),
+    e.g. to convert it between the text and the binary format; converting
+    a text file to binary and back gives the same text
+    """
+    with source._locked() as lock:
+        (records, end) = source._read_records(0)
+        texts = [source._to_text(record) for record in records]
+    del records
+    with target._locked() as lock:
+        target._rewrite(lock, target.magic + b''.join([target._from_text(text) for text in texts]))
+
+
+class HistoryFileDamaged(Exception):
+    """The checksum of a history file doesn't match its contents"""
+    pass
+
+
+class HistoryFile:
+    """
+    A history file, used as an append-only journal shared by the running
+    PyCmd instances
+
+    Each record is a line of text: the metadata prefix (time, run count and
+    so on), then the command or directory. Saving a line only appends a record
+    (and syncs it to the disk); the same line may be recorded several times,
+    in which case the last record wins. Removing the outdated records and
+    truncating the file to its maximum length is left to the compaction,
+    which happens when the file has grown enough since the last one (see
+    compact for the retention policy).
+
+    Writes are serialized between instances with an advisory lock on a
+    companion .lock file, which also holds the number of compactions so
+    far (the generation of the file). Each instance tags its records with
+    its id and a sequence number, and can pick up the records appended by
+    the others by reading the file from where it left off, or by their
+    sequence numbers once the file was compacted (see tail).
+
+    The file is only ever rewritten as a whole (when compacting) by writing
+    a temporary file and renaming it over the history file, so a crash can't
+    leave it half-written. The rewritten records end with a checksum trailer
+    (the records appended later follow it); if the checksum doesn't match
+    when reading the file, the previous generation of the file, kept as a
+    .bak file, is restored and the records that followed the trailer are
+    replayed on it.
+
+    The format of the records is defined by _read_records, _decode, _encode,
+    _seq, _to_text, _from_text, _format_records, _checksum and _trailer_end
+    (see BinaryHistoryFile).
+    """
+
+    # Signature at the start of the file
+    magic = b''
+
+    # When deciding which older lines to drop, running a line counts twice
+    # as much as running it this long earlier (see compact)
+    retention_half_life = 90 * 24 * 3600
+
+    def __init__(self, filename, max_length, keep_days = 0):
+        self.filename = filename
+
+        # Retention policy: the maximum number of distinct lines, and the
+        # number of days during which every record is kept
+        self.max_length = max_length
+        self.keep_days = keep_days
+
+        # Id of this instance and sequence number of its last record
+        self.instance = uuid.uuid4().hex[:8]
+        self.seq = 0
+
+        # Sequence number of the last record read from each other instance
+        self.last_seqs = {}
+
+        # Number of records in the file, the last one appended (as a line
+        # and its metadata prefix, see _key), and the position (in bytes)
+        # and generation of the file up to which we read it (None if not
+        # read yet)
+        self.records = 0
+        self.last_record = None
+        self.offset = None
+        self.generation = None
+
+        # Number of records above which the file gets compacted
+        self.compact_at = 2 * max_length
+
+        # Serializes the access to the above between threads (e.g. with a
+        # HistoryWriter appending in the background)
+        self.mutex = threading.Lock()
+
+        # The warnings about the file, e.g. when it is damaged; they may come
+        # from a background thread, so they are left to the caller to show
+        # when it won't mess up the prompt (see pop_warnings)
+        self.warnings = collections.deque()
+
+    def pop_warnings(self):
+        """Return the warnings about the file since the last call (and forget them)"""
+        return [self.warnings.popleft() for i in range(len(self.warnings))]
+
+    def read(self, newest_first = False, every_run = False):
+        """
+        Return an iterator over the (line, metadata) pairs in the history
+        file, without duplicates (or with every run of the lines recorded),
+        oldest first (or newest first); the file is only read and parsed as
+        the iterator is consumed.
+        """
+        if os.path.isfile(self.filename):
+            records = self._parse(every_run)
+            return records if newest_first else iter(list(records)[::-1])
+        else:
+            self.warnings.append('Warning: Can\'t open ' + os.path.basename(self.filename) + '!')
+            self.offset = 0
+            return iter(())
+
+    def _parse(self, every_run = False):
+        """
+        Generate the (line, metadata) pairs in the history file (the last
+        record of each line, or every record), newest first
+        """
+        with self._locked() as lock:
+            self.generation = self._generation(lock)
+            try:
+                (records, self.offset) = self._read_records(0, verify = True)
+            except HistoryFileDamaged:
+                (records, self.offset) = self._restore(lock)
+            self.records = len(records)
+            for record in records:
+                self._is_new(record)
+            self.last_record = self._key(*self._decode(records[-1])) if records else None
+        seen = set()
+        for record in reversed(records):
+            (line, meta) = self._decode(record)
+            if not every_run:
+                if line in seen:
+                    continue
+                seen.add(line)
+            meta.pop('seq', None)
+            yield (line, meta)
+
+    def tail(self):
+        """
+        Return the (line, metadata) pairs recorded by the other instances
+        since the file was last read, oldest first
+        """
+        if self.offset is None or not os.path.isfile(self.filename):
+            return []
+        with self._locked() as lock:
+            generation = self._generation(lock)
+            compacted = self.generation is not None and generation != self.generation
+            self.generation = generation
+            if compacted:
+                # The file was compacted since, our position in it is lost;
+                # read it again, the records we haven't seen yet are told
+                # apart by their sequence numbers
+                (records, self.offset) = self._read_records(0)
+                self.records = len(records)
+            else:
+                (records, self.offset) = self._read_records(self.offset)
+            others = []
+            for record in records:
+                # Without a sequence number (from older versions), a record
+                # is new if it follows our position in the file
+                if self._is_new(record, not compacted):
+                    (line, meta) = self._decode(record)
+                    meta.pop('seq', None)
+                    others.append((line, meta))
+            if not compacted:
+                self.records += len(others)
+        return others
+
+    def _is_new(self, record, unnumbered = False):
+        """
+        Tell whether a record comes from another instance and wasn't read
+        yet, i.e. its sequence number is above the last one read from that
+        instance (and note it); records without one are new if unnumbered
+        """
+        seq = self._seq(record)
+        if seq is None:
+            return unnumbered
+        (instance, number) = seq
+        if instance == self.instance or number <= self.last_seqs.get(instance, 0):
+            return False
+        self.last_seqs[instance] = number
+        return True
+
+    def append(self, line, meta = None):
+        """Record a line (with its metadata) at the end of the history file"""
+        self.append_all([(line, meta)])
+
+    def append_all(self, records):
+        """
+        Record (line, metadata) pairs at the end of the history file, with a
+        single write
+        """
+        with self._locked() as lock:
+            generation = self._generation(lock)
+            data = []
+            for (line, meta) in records:
+                meta = dict(meta or {})
+                key = self._key(line, meta)
+                if key == self.last_record:
+                    # No update
+                    continue
+                if meta.get('time') is None:
+                    meta['time'] = time.time()
+                self.seq += 1
+                meta['seq'] = '%s:%d' % (self.instance, self.seq)
+                data.append(self._encode(line, meta, generation))
+                self.last_record = key
+            if not data:
+                return
+            with open(self.filename, 'ab') as history_file:
+                at_end = history_file.tell() == self.offset
+                if history_file.tell() == 0:
+                    history_file.write(self.magic)
+                history_file.write(b''.join(data))
+                history_file.flush()
+                os.fsync(history_file.fileno())
+                if at_end:
+                    # Nothing new from the other instances, no need to read
+                    # our own records back
+                    self.offset = history_file.tell()
+            self.records += len(data)
+            if self.records > self.compact_at:
+                try:
+                    self.compact(lock)
+                except OSError:
+                    # E.g. another instance still has the file mapped on
+                    # Windows; the records are safe, compact next time
+                    pass
+
+    def compact(self, lock):
+        """
+        Rewrite the history file without the outdated records (with the lock
+        held). The retention is tiered:
+          * the records from the last keep_days days are all kept
+          * older records are deduplicated, only the last one of each line
+            is kept
+          * if there are more than max_length distinct lines, the older
+            lines that were run the least often and the least recently (or
+            whose last run failed) are dropped; like with the frecency
+            ranking (see HistoryRanking), but with a longer half-life so that
+            a line run often a few months ago outweighs one run once since
+        """
+        (records, end) = self._read_records(0)
+        cutoff = time.time() - self.keep_days * 24 * 3600
+        kept = []
+        older = []
+        seen = set()
+        for record in reversed(records):
+            (line, meta) = self._decode(record)
+            if self.keep_days and meta.get('time', 0) >= cutoff:
+                kept.append(record)
+            elif line not in seen:
+                score = (math.log2(max(meta.get('count', 1), 1))
+                         + meta.get('time', 0) / self.retention_half_life
+                         - (1 if meta.get('exit_code', 0) != 0 else 0))
+                older.append((score, -len(kept)))
+                kept.append(record)
+            seen.add(line)
+        if len(seen) > self.max_length:
+            dropped = set([-i for (score, i) in heapq.nsmallest(len(seen) - self.max_length, older)])
+            kept = [kept[i] for i in range(len(kept)) if i not in dropped]
+        kept.reverse()
+        data = self.magic + self._format_records(kept)
+        count = len(kept)
+        # Let go of the records before rewriting (a memory-mapped file can't
+        # be replaced on Windows)
+        records = kept = record = None
+        self._rewrite(lock, data)
+        self.records = count
+        self.compact_at = max(2 * self.max_length, count + self.max_length)
+
+    def _rewrite(self, lock, data):
+        """
+        Replace the contents of the history file (with the lock held), adding
+        the checksum trailer; the current file is kept as a backup
+        """
+        data += self._checksum(data)
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as history_file:
+            history_file.write(data)
+            history_file.flush()
+            os.fsync(history_file.fileno())
+        if os.path.isfile(self.filename):
+            shutil.copyfile(self.filename, self.filename + '.bak')
+        os.replace(temp_filename, self.filename)
+        self.offset = len(data)
+        # Our generation is left behind, so that tail reads the file again
+        # for the records appended by the other instances since we last read
+        # it (as after a compaction by another instance)
+        self._set_generation(lock, self._generation(lock) + 1)
+
+    def _restore(self, lock):
+        """
+        Restore the backup of a damaged history file (with the lock held),
+        then replay the records appended to the damaged file since its last
+        compaction; return the records and the position after them (see
+        _read_records)
+        """
+        backup_filename = self.filename + '.bak'
+        self.warnings.append('Warning: ' + os.path.basename(self.filename) + ' is damaged!')
+        if not os.path.isfile(backup_filename):
+            # Salvage what we can
+            return self._read_records(0)
+
+        # The records appended since the last compaction follow the checksum
+        # trailer, the damage is most likely in the (much longer) compacted
+        # records before it
+        appended = []
+        trailer_end = self._trailer_end()
+        if trailer_end is not None:
+            appended = [self._to_text(record) for record in self._read_records(trailer_end)[0]]
+
+        shutil.copyfile(self.filename, self.filename + '.bad')
+        os.replace(backup_filename, self.filename)
+        self.generation = self._generation(lock) + 1
+        self._set_generation(lock, self.generation)
+        try:
+            (records, end) = self._read_records(0, verify = True)
+        except HistoryFileDamaged:
+            return self._read_records(0)
+        if appended:
+            # Let go of the records first (a memory-mapped file can't be
+            # truncated on Windows)
+            records = None
+            with open(self.filename, 'r+b') as history_file:
+                # Drop an incomplete last record, if any
+                history_file.truncate(end)
+                history_file.seek(end)
+                history_file.write(b''.join([self._from_text(text) for text in appended]))
+                history_file.flush()
+                os.fsync(history_file.fileno())
+            (records, end) = self._read_records(0)
+        return (records, end)
+
+    def _key(self, line, meta):
+        """
+        Return what tells a record apart from the previous one, i.e. the
+        line and its metadata (but not its time or sequence number)
+        """
+        return (line, format_history_meta(dict(meta, time=None, seq=None)))
+
+    def _read_records(self, offset, verify = False):
+        """
+        Return the complete records in the history file from the given
+        position on, and the position after them; raise HistoryFileDamaged
+        if verifying the checksum (when reading from the start) fails
+        """
+        with open(self.filename, 'rb') as history_file:
+            history_file.seek(offset)
+            data = history_file.read()
+        # An incomplete last record is still being written
+        end = data.rfind(b'\n') + 1
+        if verify and offset == 0:
+            self._verify(data[:end])
+        records = data[:end].decode('utf-8', 'replace').split('\n')[:-1]
+        return ([record.rstrip('\r') for record in records
+                 if not record.startswith(checksum_prefix)], offset + end)
+
+    def _trailer_end(self):
+        """
+        Return the position after the last checksum trailer in the history
+        file (where the records appended since the last compaction start),
+        or None
+        """
+        with open(self.filename, 'rb') as history_file:
+            data = history_file.read()
+        prefix = checksum_prefix.encode()
+        start = data.rfind(b'\n' + prefix) + 1
+        if start == 0 and not data.startswith(prefix):
+            return None
+        end = data.find(b'\n', start)
+        return end + 1 if end >= 0 else None
+
+    def _verify(self, data):
+        """Check the checksum trailer (if any) of the data of a text history file"""
+        prefix = checksum_prefix.encode()
+        if data.startswith(prefix):
+            start = 0
+        else:
+            start = data.find(b'\n' + prefix) + 1
+            if start == 0:
+                return
+        end = data.find(b'\n', start)
+        try:
+            checksum = int(data[start + len(prefix) : end], 16)
+        except ValueError:
+            raise HistoryFileDamaged(self.filename)
+        if zlib.crc32(data[:start]) != checksum:
+            raise HistoryFileDamaged(self.filename)
+
+    def _decode(self, record):
+        """Return the (line, metadata) pair in a record (see _read_records)"""
+        return parse_record(record)
+
+    def _seq(self, record):
+        """
+        Return the instance id and sequence number of a record (see
+        _read_records), or None
+        """
+        return record_seq(record)
+
+    def _encode(self, line, meta, generation):
+        """
+        Return the data to append to the file (of the given generation) to
+        record a line and its metadata
+        """
+        return self._from_text(format_record(line, meta))
+
+    def _to_text(self, record):
+        """Return a record in the text format"""
+        return record
+
+    def _from_text(self, text):
+        """Return the data recording a record in the text format"""
+        return (text + u'\n').encode('utf-8')
+
+    def _format_records(self, records):
+        """
+        Return the data recording the given records, e.g. after compaction
+        (which rewrites the records of older files with a time field)
+        """
+        return b''.join([self._from_text(format_record(*parse_record(record))) for record in records])
+
+    def _checksum(self, data):
+        """Return the checksum trailer for the data of a history file"""
+        return (checksum_prefix + '%08x\n' % zlib.crc32(data)).encode()
+
+    def _generation(self, lock):
+        """Return the generation of the history file, stored in the lock file"""
+        os.lseek(lock, 0, os.SEEK_SET)
+        try:
+            return int(os.read(lock, 32) or 0)
+        except ValueError:
+            return 0
+
+    def _set_generation(self, lock, generation):
+        """Store the generation of the history file in the lock file"""
+        os.lseek(lock, 0, os.SEEK_SET)
+        os.ftruncate(lock, 0)
+        os.write(lock, str(generation).encode())
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock on the history file (as a file descriptor on the lock
+        file); this is advisory and best effort, if locking fails (e.g. when
+        another instance hangs) we go on anyway
+        """
+        with self.mutex:
+            with self._file_locked() as lock:
+                yield lock
+
+    @contextlib.contextmanager
+    def _file_locked(self):
+        """Hold the lock file of the history file (see _locked)"""
+        lock = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT)
+        try:
+            try:
+                if msvcrt:
+                    # Lock the first byte of the file; this retries for 10
+                    # seconds
+                    os.lseek(lock, 0, os.SEEK_SET)
+                    msvcrt.locking(lock, msvcrt.LK_LOCK, 1)
+                else:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                locked = True
+            except OSError:
+                locked = False
+            yield lock
+        finally:
+            if locked:
+                if msvcrt:
+                    os.lseek(lock, 0, os.SEEK_SET)
+                    msvcrt.locking(lock, msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+
+
+# Header of the records in a binary history file: the length of the payload
+# (the line, in UTF-8) that follows it, the time (in seconds since the epoch),
+# the id of the directory, the run count, the exit code, the duration (in
+# milliseconds), the instance id and sequence number, and the flags
+binary_header = struct.Struct('<IqQIiIIIH')
+
+# The fields of the header that hold a value
+binary_time = 0x01
+binary_count = 0x02
+binary_exit_code = 0x04
+binary_seq = 0x08
+binary_duration = 0x80
+
+# The record names the directory with the id in its header (the payload is
+# the path) rather than recording a line
+binary_dir = 0x10
+
+# The payload is the record in the text format, which the header can't
+# represent (this keeps the conversion from text lossless)
+binary_text = 0x20
+
+# The record comes from an older text file, with the time as a tail datetime
+binary_legacy = 0x40
+
+# The record is the checksum trailer, with the checksum as the run count
+binary_checksum = 0x100
+
+
+class BinaryHistoryFile(HistoryFile):
+    """
+    A history file in a binary format: a signature, then a sequence of
+    records with a fixed-size header (see binary_header) and the line
+
+    The directories of the lines are recorded once, by records mapping the
+    (hash-based) id in the headers to the path, ahead of the first line that
+    uses them. Reading the file maps it in memory and only walks through the
+    headers; the lines are decoded as they are consumed, without copying
+    the data.
+    """
+
+    magic = b'PyCmdH\x02\n'
+
+    def __init__(self, filename, max_length, keep_days = 0):
+        HistoryFile.__init__(self, filename, max_length, keep_days)
+
+        # Paths of the directories by id, and the generation of the file and
+        # the ids that it names
+        self.dirs = {}
+        self.named_dirs = (None, set())
+
+    def _read_records(self, offset, verify = False):
+        """
+        Return the complete records in the history file from the given
+        position on (as views of the mapped file), and the position after
+        them; raise HistoryFileDamaged if verifying the checksum (when
+        reading from the start) fails
+        """
+        with open(self.filename, 'rb') as history_file:
+            size = os.fstat(history_file.fileno()).st_size
+            if size <= max(offset, len(self.magic)):
+                return ([], max(offset, size))
+            data = memoryview(mmap.mmap(history_file.fileno(), 0, access = mmap.ACCESS_READ))
+        if offset < len(self.magic):
+            if data[:len(self.magic)] != self.magic:
+                self.warnings.append('Warning: ' + os.path.basename(self.filename)
+                                     + ' is not a PyCmd history file!')
+                return ([], size)
+            offset = len(self.magic)
+        if self.named_dirs[0] != self.generation:
+            self.named_dirs = (self.generation, set())
+        records = []
+        while offset + binary_header.size <= size:
+            header = binary_header.unpack_from(data, offset)
+            end = offset + binary_header.size + header[0]
+            if end > size:
+                # An incomplete last record is still being written
+                break
+            (dir_id, flags) = (header[2], header[-1])
+            if flags & binary_dir:
+                self.dirs[dir_id] = str(data[offset + binary_header.size : end], 'utf-8', 'replace')
+                self.named_dirs[1].add(dir_id)
+            elif flags & binary_checksum:
+                if verify and zlib.crc32(data[:offset]) != header[3]:
+                    raise HistoryFileDamaged(self.filename)
+            else:
+                records.append(data[offset : end])
+            offset = end
+        return (records, offset)
+
+    def _trailer_end(self):
+        """
+        Return the position after the last checksum trailer in the history
+        file (where the records appended since the last compaction start),
+        or None; the directories named on the way are noted
+        """
+        with open(self.filename, 'rb') as history_file:
+            data = history_file.read()
+        if data[:len(self.magic)] != self.magic:
+            return None
+        (offset, trailer_end) = (len(self.magic), None)
+        while offset + binary_header.size <= len(data):
+            header = binary_header.unpack_from(data, offset)
+            end = offset + binary_header.size + header[0]
+            if end > len(data):
+                break
+            if header[-1] & binary_dir:
+                self.dirs[header[2]] = str(data[offset + binary_header.size : end], 'utf-8', 'replace')
+            elif header[-1] & binary_checksum:
+                trailer_end = end
+            offset = end
+        return trailer_end
+
+    def _decode(self, record):
+        """Return the (line, metadata) pair in a record (see _read_records)"""
+        (length, stamp, dir_id, count, exit_code, duration, instance, seq, flags) = binary_header.unpack_from(record)
+        line = str(record[binary_header.size:], 'utf-8', 'replace')
+        if flags & binary_text:
+            return parse_record(line)
+        meta = {}
+        if flags & binary_time:
+            meta['time'] = stamp
+        if flags & binary_count:
+            meta['count'] = count
+        if flags & binary_exit_code:
+            meta['exit_code'] = exit_code
+        if flags & binary_duration:
+            meta['duration'] = duration / 1000.0
+        if dir_id in self.dirs:
+            meta['dir'] = self.dirs[dir_id]
+        if flags & binary_seq:
+            meta['seq'] = '%08x:%d' % (instance, seq)
+        return (line, meta)
+
+    def _encode(self, line, meta, generation):
+        """
+        Return the data to append to the file (of the given generation) to
+        record a line and its metadata
+        """
+        if self.named_dirs[0] != generation:
+            # The file was rewritten, possibly without the directories we named
+            self.named_dirs = (generation, set())
+        data = self._name_dir(meta.get('dir'))
+        try:
+            return data + self._pack(line, meta)
+        except (ValueError, struct.error):
+            return data + self._pack_text(format_record(line, meta))
+
+    def _seq(self, record):
+        """
+        Return the instance id and sequence number of a record (see
+        _read_records), or None
+        """
+        (instance, seq, flags) = binary_header.unpack_from(record)[-3:]
+        if flags & binary_text:
+            return record_seq(str(record[binary_header.size:], 'utf-8', 'replace'))
+        if flags & binary_seq:
+            return ('%08x' % instance, seq)
+        return None
+
+    def _to_text(self, record):
+        """Return a record in the text format"""
+        flags = binary_header.unpack_from(record)[-1]
+        if flags & binary_text:
+            return str(record[binary_header.size:], 'utf-8', 'replace')
+        return format_record(*self._decode(record), legacy = bool(flags & binary_legacy))
+
+    def _from_text(self, text):
+        """Return the data recording a record in the text format"""
+        (line, meta) = parse_record(text)
+        data = self._name_dir(meta.get('dir'))
+        try:
+            for flags in [0, binary_legacy]:
+                record = self._pack(line, meta, flags)
+                if self._to_text(memoryview(record)) == text:
+                    return data + record
+        except (ValueError, struct.error):
+            pass
+        return data + self._pack_text(text)
+
+    def _format_records(self, records):
+        """Return the data recording the given records, e.g. after compaction"""
+        self.named_dirs = (None, set())
+        data = []
+        for record in records:
+            dir_id = binary_header.unpack_from(record)[2]
+            if dir_id in self.dirs:
+                data.append(self._name_dir(self.dirs[dir_id]))
+            data.append(bytes(record))
+        return b''.join(data)
+
+    def _checksum(self, data):
+        """Return the checksum trailer for the data of a history file"""
+        return binary_header.pack(0, 0, 0, zlib.crc32(data), 0, 0, 0, 0, binary_checksum)
+
+    def _name_dir(self, dir):
+        """Return the record naming a directory, unless already in the file"""
+        if dir is None:
+            return b''
+        dir_id = dir_hash(dir)
+        if dir_id in self.named_dirs[1] and self.dirs.get(dir_id) == dir:
+            return b''
+        self.dirs[dir_id] = dir
+        self.named_dirs[1].add(dir_id)
+        payload = dir.encode('utf-8')
+        return binary_header.pack(len(payload), 0, dir_id, 0, 0, 0, 0, 0, binary_dir) + payload
+
+    def _pack(self, line, meta, flags = 0):
+        """Return a record for a line and its metadata (with extra flags)"""
+        stamp = meta.get('time')
+        if stamp is not None:
+            flags |= binary_time
+        count = meta.get('count')
+        if count is not None:
+            flags |= binary_count
+        exit_code = meta.get('exit_code')
+        if exit_code is not None:
+            flags |= binary_exit_code
+        duration = meta.get('duration')
+        if duration is not None:
+            flags |= binary_duration
+        (instance, seq) = (0, 0)
+        if meta.get('seq') is not None:
+            flags |= binary_seq
+            (instance, seq) = meta['seq'].split(':')
+            (instance, seq) = (int(instance, 16), int(seq))
+        dir = meta.get('dir')
+        payload = line.encode('utf-8')
+        return binary_header.pack(len(payload), int(stamp or 0), dir_hash(dir) if dir is not None else 0,
+                                  count or 0, exit_code or 0, int(round((duration or 0) * 1000)),
+                                  instance, seq, flags) + payload
+
+    def _pack_text(self, text):
+        """Return a record holding a record in the text format"""
+        payload = text.encode('utf-8')
+        return binary_header.pack(len(payload), 0, 0, 0, 0, 0, 0, 0, binary_text) + payload
+
+
+def dir_hash(dir):
+    """Return the id of a directory in the binary history files"""
+    return struct.unpack('<Q', hashlib.md5(dir.encode('utf-8')).digest()[:8])[0] or 1
@@ -0,0 +1,107 @@
+import sys
+from array import array
+from bisect import bisect_left
+
+class HistoryIndex:
+    """
+    Trigram inverted index over a HistoryStore, used to quickly find the
+    lines that contain a set of substrings (ignoring case)
+
+    The posting lists hold the ids of the lines in the store; since the ids
+    increase as lines are appended, the posting lists are kept sorted for free
+    and the candidates come out in history order. Removed lines are not purged
+    from the posting lists right away; their stale ids are skipped when looking
+    up and dropped when the index gets compacted.
+    """
+
+    # Posting lists longer than this are dropped and the trigram is ignored
+    # from then on; such a common trigram would not narrow down the search
+    # much anyway, and this bounds the memory used by the index
+    max_posting_len = 16384
+
+    def __init__(self, store):
+        self.store = store
+        self.saturated = set()
+        self.build()
+
+    def build(self):
+        """(Re)build the index from the lines in the store"""
+        # Trigram -> array of line ids, and the too common trigrams
+        self.postings = {}
+
+        # Number of ids in the postings for removed lines
+        self.stale = 0
+
+        for id in self.store.ids():
+            self.add(id, self.store.line(id))
+
+    def add(self, id, line):
+        """Add a line of the store to the index"""
+        for trigram in trigrams(line.lower()):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                if trigram in self.saturated:
+                    continue
+                posting = self.postings[trigram] = array('I')
+            posting.append(id)
+            if len(posting) > self.max_posting_len:
+                del self.postings[trigram]
+                self.saturated.add(trigram)
+
+    def remove(self, id):
+        """Account for a line removed from the store"""
+        self.stale += 1
+        if self.stale > len(self.store) + 1024:
+            self.build()
+
+    def lookup(self, substrings):
+        """
+        Return an iterator over the ids of the lines that may contain all the
+        given substrings, newest first; None if the substrings are too short or
+        too common to narrow down the search (i.e. all lines need to be scanned)
+        """
+        required = set()
+        for substring in substrings:
+            required.update(trigrams(substring.lower()))
+        required -= self.saturated
+        if not required:
+            return None
+
+        postings = [self.postings.get(trigram, array('I')) for trigram in required]
+        postings.sort(key=len)
+        return self._intersect(postings[0], postings[1:])
+
+    def _intersect(self, shortest, others):
+        """
+        Walk the shortest posting list backwards and yield the lines that are
+        also in the other (sorted) posting lists; this is lazy so that finding
+        the first few matches stays cheap even for common trigrams
+        """
+        for id in reversed(shortest):
+            if not self.store.is_live(id):
+                # Stale entry
+                continue
+            for posting in others:
+                i = bisect_left(posting, id)
+                if i == len(posting) or posting[i] != id:
+                    break
+            else:
+                yield id
+
+    def stats(self):
+        """Return a dictionary describing the size of the index"""
+        entries = sum([len(posting) for posting in self.postings.values()])
+        memory = (sys.getsizeof(self.postings) + sys.getsizeof(self.saturated)
+                  + sum([sys.getsizeof(posting) for posting in self.postings.values()])
+                  + sum([sys.getsizeof(trigram) for trigram in self.postings]))
+        return {'lines': len(self.store),
+                'trigrams': len(self.postings),
+                'saturated': len(self.saturated),
+                'entries': entries,
+                'stale': self.stale,
+                'memory': memory}
+
+
+def trigrams(string):
+    """Return the set of trigrams of a string"""
+    return {string[i : i + 3] for i in range(len(string) - 2)}
@@ -0,0 +1,72 @@
+import heapq, math
+from bisect import bisect_left, insort
+from HistoryStore import no_exit_code
+
+class HistoryRanking:
+    """
+    Frecency ranking of the lines in a HistoryStore
+
+    The score of a line combines how often and how recently it was run and
+    whether its last run failed. It is expressed in log2 units so that it
+    never needs to decay: a line that was run twice as often is worth as much
+    as one run a half-life later. A line only gets rescored when it is run
+    again, and the ranking is a sorted list updated by bisection rather than
+    re-sorted.
+    """
+
+    # Running a command counts twice as much as running it a week earlier
+    half_life = 7 * 24 * 3600
+
+    # Penalty for commands whose last run failed (i.e. a quarter of the score)
+    failure_penalty = 2.0
+
+    # Bonus for commands last run in the current directory
+    dir_bonus = 2.0
+
+    def __init__(self, store):
+        self.store = store
+
+        # (score, id) pairs for the lines in the store, sorted
+        self.ranked = sorted([(self.score(id), id) for id in store.ids()])
+
+    def score(self, id):
+        """Compute the frecency score of a line in the store"""
+        store = self.store
+        score = math.log2(max(store.counts[id], 1)) + store.times[id] / self.half_life
+        if store.exit_codes[id] not in (0, no_exit_code):
+            score -= self.failure_penalty
+        return score
+
+    def update(self, id, removed = None):
+        """Rank a line just appended to the store (replacing the removed id)"""
+        if removed is not None:
+            entry = (self.score(removed), removed)
+            i = bisect_left(self.ranked, entry)
+            if i < len(self.ranked) and self.ranked[i] == entry:
+                del self.ranked[i]
+        insort(self.ranked, (self.score(id), id))
+
+    def ranked_ids(self, dir = None):
+        """
+        Lazily generate the ids of the lines in the store, best ranked first;
+        the lines last run in the given directory get a bonus
+        """
+        dir_id = self.store.dir_index.get(dir.lower()) if dir else None
+        if dir_id is None:
+            return (id for (score, id) in reversed(self.ranked))
+
+        # Merge the lines run in the directory (with the bonus) with the others
+        dir_ids = self.store.dir_ids
+        in_dir = ((score + self.dir_bonus, id) for (score, id) in reversed(self.ranked)
+                  if dir_ids[id] == dir_id)
+        elsewhere = ((score, id) for (score, id) in reversed(self.ranked)
+                     if dir_ids[id] != dir_id)
+        return (id for (score, id) in heapq.merge(in_dir, elsewhere, reverse=True))
+
+    def sort(self, ids, dir = None):
+        """Sort the given line ids, best ranked first (see ranked_ids)"""
+        dir_id = self.store.dir_index.get(dir.lower()) if dir else None
+        dir_ids = self.store.dir_ids
+        def key(id):
+            return (self.score(id) + (self.dir_bonus if dir_id is not None and dir_ids[id] == dir_id else 0), id)
+        return sorted(ids, key=key, reverse=True)
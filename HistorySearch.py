@@ -0,0 +1,158 @@
+import re
+import itertools
+from FuzzyMatcher import FuzzyMatcher, lowercase
+
+def build_patterns(line):
+    """
+    Build the list of regex patterns used to search the history for the
+    given filter, from the strongest (most relevant) to the weakest tier; for
+    filters with several words, the search adds a weaker fuzzy tier (see
+    fuzzy_words)
+    """
+    # A. First use just the space as word separator; these are the most
+    # useful matches (think acronyms 'g c m' for 'git checkout master' etc)
+    words = [re.escape(w) for w in re.findall('[^\\s]+', line)] # Split the filter into words
+    boundary = '[\\s]+'
+    patterns = [
+        # Prefixes match for each word in the command (strongest, these will be the
+        # first in the list
+        '^' + boundary.join(['(' + word + ')[^\\s]*' for word in words]) + '$',
+
+        # Prefixes match for some words in the command
+        boundary.join(['(' + word + ')[^\\s]*' for word in words]),
+    ]
+
+    # B. Then split based on other separator characters as well
+    words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)] # Split the filter into words
+    boundary = '[\\s\\.\\-\\\\_]+'   # Word boundary characters
+    patterns += [
+        # Prefixes match for each word in the command (strongest, these will be the
+        # first in the list
+        '^' + boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]) + '$',
+
+        # Prefixes match for some words in the command
+        boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]),
+
+        # Exact string match
+        '(' + re.escape(line) + ')',
+    ]
+
+    if len(words) <= 1:
+        # Optimization: Skip the advanced word-based matching for empty or
+        # simple (one-word) filters -- this saves a lot of computation effort
+        # as these filters will yield a long list of matched lines!
+        patterns = [patterns[4]]
+
+    return patterns
+
+
+def fuzzy_words(line):
+    """
+    Return the words of a filter for the fuzzy tier, i.e. the substring match
+    of the words in order, anywhere in the command (weakest, these will be the
+    last results); None if the filter doesn't use that tier
+    """
+    words = re.findall('[a-zA-Z0-9]+', line)
+    return words if len(words) > 1 else None
+
+
+def required_substrings(line):
+    """
+    Return the substrings that a line must contain (ignoring case) to match
+    any of the patterns built for the given filter
+    """
+    words = re.findall('[a-zA-Z0-9]+', line)
+    if len(words) <= 1:
+        # Only the exact string match is used for simple filters
+        return [line]
+    else:
+        # Each tier requires all the words (in order)
+        return words
+
+
+class HistorySearch:
+    """
+    A history search filter, compiled once into its tiers of regex patterns
+    and its fuzzy tier
+
+    The search keeps the lines it has matched so far and the ones it has not
+    scanned yet, so that a refined filter (e.g. one more typed character) only
+    needs to look at the lines that can still match.
+    """
+    def __init__(self, filter, lines):
+        self.filter = filter
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in build_patterns(filter)]
+        words = fuzzy_words(filter)
+        self.fuzzy = FuzzyMatcher(words) if words else None
+
+        # The lines (newest first) not scanned yet
+        self.lines = iter(lines)
+
+        # The scanned lines matching any tier (i.e. the weakest one), newest first
+        self.candidates = []
+
+    def refine(self, filter):
+        """
+        Return a search for the given filter that only scans the lines still
+        able to match it, or None if the filter is not a refinement of this one
+        """
+        search = HistorySearch(filter, itertools.chain(self.candidates, self.lines))
+        # Every tier implies the weakest (fuzzy) one, and a longer filter only
+        # makes that one stricter -- unless it switches between the single-tier
+        # (one-word) and the word-based patterns
+        if filter.startswith(self.filter) \
+                and (len(search.patterns) == 1) == (len(self.patterns) == 1):
+            return search
+        else:
+            return None
+
+    def match(self, line):
+        """
+        Match a line against the tiers; return a (tier, spans, score) tuple
+        for the strongest matching tier (the score ranks the matches of the
+        fuzzy tier, it is 0 for the others), or None
+        """
+        if self.fuzzy:
+            # Every tier implies the fuzzy one, which is the quickest to rule out
+            lower = lowercase(line)
+            last = self.fuzzy.bounds(lower)
+            if last is None:
+                return None
+        for tier in range(len(self.patterns)):
+            matches = self.patterns[tier].search(line)
+            if matches:
+                return (tier, [matches.span(i) for i in range(1, matches.lastindex + 1)], 0)
+        if self.fuzzy:
+            (score, spans) = self.fuzzy.place(line, lower, last)
+            return (len(self.patterns), spans, score)
+        return None
+
+    def matches(self):
+        """
+        Lazily score the lines in a single pass and generate the (line, spans)
+        matches, ordered by tier (and score) and then by recency
+
+        Matches of the strongest tier come out as soon as they are found; the
+        weaker ones are held back until all the lines have been scanned.
+        """
+        tiers = [[] for p in self.patterns] + [[]]
+        seen = set()
+        for line in self.lines:
+            if line in seen:
+                # We already scored this line, skip
+                continue
+            seen.add(line)
+
+            matched = self.match(line)
+            if matched:
+                self.candidates.append(line)
+                if matched[0] == 0:
+                    yield (line, matched[1])
+                else:
+                    tiers[matched[0]].append((-matched[2], line, matched[1]))
+
+        for tier in tiers:
+            # The sort is stable, so equally scored lines stay in order
+            tier.sort(key=lambda match: match[0])
+            for (score, line, spans) in tier:
+                yield (line, spans)
@@ -0,0 +1,236 @@
+from array import array
+
+# Value of the exit code column when the exit code is unknown
+no_exit_code = -2 ** 63
+
+# Value of the duration column when the duration is unknown
+no_duration = -1.0
+
+class HistoryStore:
+    """
+    Compact store for a list of unique command lines
+
+    The lines are kept UTF-8 encoded in a single arena, addressed through an
+    offset table; this is much smaller than a list of Python strings for long
+    histories. Each appended line gets a new id (ids increase with recency and
+    stay valid while the line is in the store). Lines are deduplicated by
+    hash, so appending or removing a line doesn't need a linear scan.
+
+    Besides the id-based interface, the store behaves like a (read-only)
+    list of the lines, oldest first.
+
+    Each line also has some metadata, stored in columns indexed by id: the
+    time it was last run (in seconds since the epoch, 0 if unknown), the
+    number of times it was run, the exit code and duration (in seconds) of
+    its last run and the directory it was last run in (as an index in the
+    table of directories, -1 if unknown). The lines last run in each directory are also indexed, so
+    that they can be listed without scanning the whole store.
+
+    As every run of a line gets a new id, the ids also stand for the runs:
+    each id keeps the id of the first run of its line, which identifies the
+    line across its runs, and the first ids keep the id of the last run.
+    """
+
+    def __init__(self, lines = ()):
+        # The encoded lines, and the offset (-1 for removed lines) and length
+        # of each line id in the arena
+        self.arena = bytearray()
+        self.offsets = array('q')
+        self.lengths = array('I')
+
+        # The metadata columns
+        self.times = array('d')
+        self.counts = array('I')
+        self.exit_codes = array('q')
+        self.durations = array('d')
+        self.dir_ids = array('i')
+
+        # The id of the first run of the line of each id, and the id of the
+        # last run of the line of each first id
+        self.first_ids = array('I')
+        self.last_ids = array('I')
+
+        # The directories the lines were run in, and their ids (keyed by the
+        # lowercase name, paths are not case sensitive)
+        self.dirs = []
+        self.dir_index = {}
+
+        # The ids of the lines run in each directory (by directory id), oldest
+        # first; like in a HistoryIndex, the ids of lines since removed or run
+        # again are only dropped when compacting
+        self.dir_lines = []
+
+        # Hash of the line -> id; lines whose hash collides with the one of
+        # another line are kept in a separate line -> id dictionary
+        self.hashes = {}
+        self.collisions = {}
+
+        # The ids of the lines, oldest first; like in a HistoryIndex, the ids
+        # of removed lines are only dropped once there are enough of them, so
+        # that iterating over the lines doesn't take longer the more lines
+        # were ever appended
+        self.live_ids = array('I')
+        self.stale = 0
+
+        # Number of lines in the store, and bytes in the arena used by
+        # removed lines
+        self.count = 0
+        self.garbage = 0
+
+        for line in lines:
+            self.append(line)
+
+    def find(self, line):
+        """Return the id of the given line, or None if not in the store"""
+        id = self.hashes.get(hash(line))
+        if id is not None and self.line(id) == line:
+            return id
+        return self.collisions.get(line)
+
+    def line(self, id):
+        """Return the line with the given id"""
+        offset = self.offsets[id]
+        return self.arena[offset : offset + self.lengths[id]].decode('utf-8', 'surrogatepass')
+
+    def is_live(self, id):
+        """Check whether the line with the given id is still in the store"""
+        return self.offsets[id] >= 0
+
+    def meta(self, id):
+        """Return the metadata of the line with the given id as a dictionary"""
+        return {'time': self.times[id],
+                'count': self.counts[id],
+                'exit_code': None if self.exit_codes[id] == no_exit_code else self.exit_codes[id],
+                'duration': None if self.durations[id] == no_duration else self.durations[id],
+                'dir': self.dirs[self.dir_ids[id]] if self.dir_ids[id] >= 0 else None}
+
+    def dir_id(self, dir):
+        """Return the id of a directory, adding it to the table if needed"""
+        key = dir.lower()
+        id = self.dir_index.get(key)
+        if id is None:
+            id = self.dir_index[key] = len(self.dirs)
+            self.dirs.append(dir)
+            self.dir_lines.append(array('I'))
+        return id
+
+    def ids_in_dir(self, dir):
+        """Iterate over the ids of the lines last run in a directory, newest first"""
+        id = self.dir_index.get(dir.lower())
+        if id is None:
+            return iter(())
+        offsets = self.offsets
+        return (line_id for line_id in reversed(self.dir_lines[id]) if offsets[line_id] >= 0)
+
+    def append(self, line, time = 0, count = None, exit_code = None, duration = None, dir = None):
+        """
+        Append a line (removing its previous occurrence, if any) and return
+        its new id. Unless given, the run count is one more than the one of
+        the previous occurrence.
+        """
+        previous = self.remove(line)
+        if count is None:
+            count = self.counts[previous] + 1 if previous is not None else 1
+
+        encoded = line.encode('utf-8', 'surrogatepass')
+        id = len(self.offsets)
+        self.offsets.append(len(self.arena))
+        self.lengths.append(len(encoded))
+        self.arena += encoded
+        self.live_ids.append(id)
+        self.count += 1
+
+        self.times.append(time)
+        self.counts.append(count)
+        self.exit_codes.append(no_exit_code if exit_code is None else exit_code)
+        self.durations.append(no_duration if duration is None else duration)
+        if dir is None:
+            self.dir_ids.append(-1)
+        else:
+            self.dir_ids.append(self.dir_id(dir))
+            self.dir_lines[self.dir_ids[id]].append(id)
+        self.first_ids.append(self.first_ids[previous] if previous is not None else id)
+        self.last_ids.append(id)
+        self.last_ids[self.first_ids[id]] = id
+
+        key = hash(line)
+        if key in self.hashes:
+            self.collisions[line] = id
+        else:
+            self.hashes[key] = id
+        return id
+
+    def remove(self, line):
+        """Remove a line from the store; return its id, or None if not found"""
+        id = self.find(line)
+        if id is None:
+            return None
+
+        key = hash(line)
+        if self.hashes.get(key) == id:
+            del self.hashes[key]
+        else:
+            del self.collisions[line]
+        self.offsets[id] = -1
+        self.count -= 1
+        self.garbage += self.lengths[id]
+        if self.garbage > 65536 and self.garbage > len(self.arena) // 2:
+            self.compact()
+        self.stale += 1
+        if self.stale > self.count + 1024:
+            offsets = self.offsets
+            self.live_ids = array('I', [live_id for live_id in self.live_ids if offsets[live_id] >= 0])
+            self.stale = 0
+        return id
+
+    def compact(self):
+        """Drop the removed lines from the arena (the ids are preserved)"""
+        arena = bytearray()
+        for id in range(len(self.offsets)):
+            offset = self.offsets[id]
+            if offset >= 0:
+                self.offsets[id] = len(arena)
+                arena += self.arena[offset : offset + self.lengths[id]]
+        self.arena = arena
+        self.garbage = 0
+        self.dir_lines = [array('I', [id for id in ids if self.offsets[id] >= 0])
+                          for ids in self.dir_lines]
+
+    def ids(self):
+        """Iterate over the ids of the lines, oldest first"""
+        offsets = self.offsets
+        return (id for id in self.live_ids if offsets[id] >= 0)
+
+    def reversed_ids(self):
+        """Iterate over the ids of the lines, newest first"""
+        offsets = self.offsets
+        return (id for id in reversed(self.live_ids) if offsets[id] >= 0)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, line):
+        return self.find(line) is not None
+
+    def __iter__(self):
+        return (self.line(id) for id in self.ids())
+
+    def __reversed__(self):
+        return (self.line(id) for id in self.reversed_ids())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('history index out of range')
+        if index < self.count // 2:
+            ids = self.ids()
+        else:
+            ids = self.reversed_ids()
+            index = self.count - 1 - index
+        for id in ids:
+            if index == 0:
+                return self.line(id)
+            index -= 1
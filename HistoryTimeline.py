@@ -0,0 +1,116 @@
+import heapq
+from array import array
+from collections import Counter
+from bisect import bisect_left
+from HistoryStore import no_duration
+
+class HistoryTimeline:
+    """
+    Index of the lines in a HistoryStore by the time they were last run, used
+    to answer time-range queries without scanning the whole history
+
+    The times and the ids are kept in two parallel arrays sorted by time, so
+    a range is found by bisection. Lines are run in time order, so adding one
+    is usually an append; the lines merged from other PyCmd instances may be
+    a bit older and get inserted. Like in a HistoryIndex, the ids of removed
+    lines are skipped when looking up and dropped when rebuilding.
+
+    Every run of the lines is also logged the same way (see HistoryStore:
+    the ids of the earlier runs of a line are the removed ones), so that the
+    runs in a range can be counted.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.build()
+
+        # The times and the ids of all the runs, sorted by time
+        times = store.times
+        runs = sorted(range(len(store.offsets)), key=lambda id: times[id])
+        self.run_times = array('d', [times[id] for id in runs])
+        self.run_ids = array('I', runs)
+
+    def build(self):
+        """(Re)build the index from the lines in the store"""
+        times = self.store.times
+        ids = sorted(self.store.ids(), key=lambda id: times[id])
+        self.times = array('d', [times[id] for id in ids])
+        self.ids = array('I', ids)
+
+        # Number of ids in the index for removed lines
+        self.stale = 0
+
+    def add(self, id):
+        """Add a line of the store (i.e. its last run) to the index and the log"""
+        time = self.store.times[id]
+        insert(self.times, self.ids, time, id)
+        insert(self.run_times, self.run_ids, time, id)
+
+    def remove(self, id):
+        """Account for a line removed from the store"""
+        self.stale += 1
+        if self.stale > len(self.store) + 1024:
+            self.build()
+
+    def between(self, start = None, end = None):
+        """
+        Iterate over the ids of the lines last run in [start, end) (either
+        bound may be None), oldest first
+        """
+        first = bisect_left(self.times, start) if start is not None else 0
+        last = bisect_left(self.times, end) if end is not None else len(self.times)
+        is_live = self.store.is_live
+        ids = self.ids
+        return (ids[i] for i in range(first, last) if is_live(ids[i]))
+
+    def latest(self, count, end = None):
+        """Return the ids of the (up to count) lines last run before end, newest first"""
+        last = bisect_left(self.times, end) if end is not None else len(self.times)
+        is_live = self.store.is_live
+        ids = self.ids
+        latest = []
+        for i in range(last - 1, -1, -1):
+            if len(latest) == count:
+                break
+            if is_live(ids[i]):
+                latest.append(ids[i])
+        return latest
+
+    def top(self, count, start = None, end = None):
+        """
+        Return the (up to count) lines run the most often in [start, end)
+        (either bound may be None) as (number of runs, id) pairs, most run
+        first (then most recently run first)
+
+        The history file only keeps every run for a while, the earlier runs
+        of a line are compacted into its last one (see HistoryFile.compact).
+        """
+        first = bisect_left(self.run_times, start) if start is not None else 0
+        last = bisect_left(self.run_times, end) if end is not None else len(self.run_times)
+        first_ids = self.store.first_ids
+        runs = Counter(map(first_ids.__getitem__, self.run_ids[first : last]))
+        last_ids = self.store.last_ids
+        times = self.store.times
+        top = heapq.nlargest(count, runs, key=lambda line: (runs[line], times[last_ids[line]]))
+        return [(runs[line], last_ids[line]) for line in top]
+
+    def slowest(self, count, start = None, end = None):
+        """
+        Return the ids of the (up to count) slowest lines among the ones last
+        run in [start, end) and whose duration is known, slowest first
+        """
+        durations = self.store.durations
+        return heapq.nlargest(count, (id for id in self.between(start, end)
+                                      if durations[id] != no_duration),
+                              key=lambda id: durations[id])
+
+
+def insert(times, ids, time, id):
+    """Insert a time and an id in parallel arrays sorted by time"""
+    if not times or time >= times[-1]:
+        times.append(time)
+        ids.append(id)
+    else:
+        i = bisect_left(times, time)
+        times.insert(i, time)
+        ids.insert(i, id)
@@ -0,0 +1,76 @@
+class HistoryWords:
+    """
+    Index of the words in the command history, used to expand the word at
+    the cursor (Alt-/) without splitting every line of the history again
+
+    For each distinct word, the index keeps how many times it occurs in the
+    history, when it was last added and how many times it follows each other
+    word (its context, compared ignoring case). It is maintained as lines
+    are added to and removed from the history, and looking up candidates only
+    scans the distinct words.
+    """
+
+    def __init__(self, lines = ()):
+        # Word -> [occurrences, last time added, {context: occurrences}, lowercase word]
+        self.words = {}
+
+        # Incremented each time a line is added, to order the words by recency
+        self.clock = 0
+
+        for line in lines:
+            self.add(line)
+
+    def add(self, line):
+        """Add the words of a line (the newest one in the history)"""
+        self.clock += 1
+        words = self.words
+        context = ''
+        for word in line.split(' '):
+            if word:
+                entry = words.get(word)
+                if entry is None:
+                    entry = words[word] = [1, self.clock, {context: 1}, word.lower()]
+                else:
+                    entry[0] += 1
+                    entry[1] = self.clock
+                    contexts = entry[2]
+                    contexts[context] = contexts.get(context, 0) + 1
+                context = entry[3]
+            else:
+                context = ''
+
+    def remove(self, line):
+        """Remove the words of a line (e.g. before adding it again)"""
+        for (context, word) in word_pairs(line):
+            entry = self.words.get(word)
+            if entry is None:
+                continue
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self.words[word]
+                continue
+            contexts = entry[2]
+            contexts[context] -= 1
+            if contexts[context] <= 0:
+                del contexts[context]
+
+    def expansions(self, stub, context):
+        """
+        Return the words that contain the given stub (ignoring case, and
+        other than the stub itself), best first: the ones that most often
+        follow the given context word, then the most frequent ones, then the
+        most recent ones
+        """
+        stub = stub.lower()
+        context = context.lower()
+        candidates = [(entry[2].get(context, 0), entry[0], entry[1], word)
+                      for (word, entry) in self.words.items()
+                      if stub in entry[3] and entry[3] != stub]
+        candidates.sort(reverse=True)
+        return [word for (in_context, count, last, word) in candidates]
+
+
+def word_pairs(line):
+    """Return the (lowercase preceding word, word) pairs in a line"""
+    words = [''] + line.split(' ')
+    return [(words[i - 1].lower(), words[i]) for i in range(1, len(words)) if words[i]]
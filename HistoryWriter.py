@@ -0,0 +1,133 @@
+import time, threading, queue, collections
+
+class HistoryWriter:
+    """
+    Background thread saving the lines recorded in history files, so that
+    the prompt never waits for the disk
+
+    The lines are queued (the queue is bounded, so a stuck disk eventually
+    holds the caller back instead of piling up memory). The thread waits for
+    a short while after the first queued line to batch the following ones:
+    the lines for the same file are written together, with a single lock and
+    sync, and a line queued again within the batch is only written once (the
+    last record of a line wins anyway).
+
+    The thread also fetches the records appended to the history files by
+    the other PyCmd instances (see HistoryFile.tail), which take the same
+    locks, so that the prompt only picks up the records fetched already.
+
+    Errors are caught so that the thread keeps going, and reported as
+    warnings for the prompt to show (see pop_warnings).
+    """
+
+    # How long to wait for more lines before writing a batch (in seconds)
+    delay = 0.5
+
+    # How many lines can be waiting to be written
+    max_queued = 1024
+
+    def __init__(self):
+        self.queue = queue.Queue(self.max_queued)
+
+        # The records fetched from each history file, and the files to fetch
+        # from (shared with the thread)
+        self.tailed = {}
+        self.tail_pending = set()
+        self.mutex = threading.Lock()
+
+        # The warnings about the lines that couldn't be saved
+        self.warnings = collections.deque()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, history_file, line, meta = None):
+        """Queue a line (with its metadata) to be appended to a history file"""
+        self.queue.put((history_file, line, meta))
+
+    def tail(self, history_file):
+        """
+        Return the (line, metadata) pairs recorded by the other instances in
+        a history file that were fetched since the last call, oldest first,
+        and queue fetching the next ones; this never waits for the disk
+        """
+        with self.mutex:
+            records = self.tailed.pop(history_file, [])
+            if history_file in self.tail_pending:
+                return records
+            self.tail_pending.add(history_file)
+        try:
+            self.queue.put_nowait(history_file)
+        except queue.Full:
+            # Lines are piling up, fetch next time
+            with self.mutex:
+                self.tail_pending.discard(history_file)
+        return records
+
+    def pop_warnings(self):
+        """Return the warnings since the last call (and forget them)"""
+        return [self.warnings.popleft() for i in range(len(self.warnings))]
+
+    def flush(self, timeout = 10):
+        """
+        Write the queued lines right away and wait for them to be written (up
+        to the timeout, in seconds); return whether they were
+        """
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _run(self):
+        """Write the queued lines in batches (in the background thread)"""
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.delay
+            while not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._write([item for item in batch if not isinstance(item, threading.Event)])
+            except Exception as error:
+                # Keep going, or the queue would fill up and hold the prompt
+                self.warnings.append('Warning: Can\'t save the history: ' + str(error))
+            if isinstance(batch[-1], threading.Event):
+                batch[-1].set()
+
+    def _write(self, batch):
+        """
+        Append a batch of queued lines to their history files, then fetch
+        the records of the other instances from the files queued for it
+        """
+        # Group the lines by file, keeping the last occurrence of each line
+        files = []
+        records = {}
+        for (history_file, line, meta) in [item for item in batch if isinstance(item, tuple)]:
+            if history_file not in records:
+                files.append(history_file)
+                records[history_file] = {}
+            records[history_file].pop(line, None)
+            records[history_file][line] = meta
+        for history_file in files:
+            try:
+                history_file.append_all(list(records[history_file].items()))
+            except Exception as error:
+                self.warnings.append('Warning: Can\'t save ' + history_file.filename + ': ' + str(error))
+
+        for history_file in [item for item in batch if not isinstance(item, tuple)]:
+            try:
+                tailed = history_file.tail()
+            except (OSError, UnicodeError):
+                # Try again next time
+                tailed = []
+            except Exception as error:
+                self.warnings.append('Warning: Can\'t read ' + history_file.filename + ': ' + str(error))
+                tailed = []
+            with self.mutex:
+                self.tailed.setdefault(history_file, []).extend(tailed)
+                self.tail_pending.discard(history_file)
@@ -523,29 +523,11 @@ class InputState:
             expand_stub = line_words[-1]
             expand_context = line_words[-2]
 
-            context_matches = []
-            no_context_matches = []
-            for line in reversed(self.history.list):
-                line_words = [''] + line.split(' ')  #TODO: handle "
-                for i in range(len(line_words) - 1, 0, -1):
-                    word = line_words[i]
-                    context = line_words[i - 1]
-                    #if (word.lower().startswith(expand_stub.lower())
-                    if ((word.lower().find(expand_stub.lower()) != -1)
-                        and word.lower() != expand_stub.lower()): 
-                        if context.lower() == expand_context.lower():
-                            context_matches.append(word)
-                        else:
-                            no_context_matches.append(word)
-
-            # print '\n\n', no_context_matches, context_matches, '\n\n'
-
+            # The candidates come from the word index of the history, the
+            # ones most used after the same word first
             self.expand_stub = expand_stub
-            matches_set = {}
-            self.expand_matches = [matches_set.setdefault(e, e) 
-                                   for e in context_matches + no_context_matches
-                                   if e not in matches_set] + [self.expand_stub]
-            # print '\n\n', self.expand_matches, '\n\n'
+            self.expand_matches = (self.history.expansions(expand_stub, expand_context)
+                                   + [self.expand_stub])
 
         match = self.expand_matches[0]
         self.before_cursor = self.expand_line[:len(self.expand_line) 
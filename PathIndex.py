@@ -0,0 +1,106 @@
+import os, time, threading
+from bisect import bisect_left
+from common import expand_env_vars, has_exec_extension
+
+class PathIndex:
+    """
+    Index of the executables found in the directories of the PATH, used to
+    complete command names without listing these directories on each Tab
+
+    The names are kept sorted (ignoring case), so the completions for a
+    prefix are found by bisection. The index is built in a background thread
+    and refreshed the same way after running commands, when the PATH changed
+    or a while after the last check; only the directories whose modification
+    time changed since they were last listed are listed again.
+    """
+
+    # How long before checking the directories for changes again (in seconds)
+    check_interval = 60
+
+    def __init__(self):
+        # Directory -> (modification time, executables in it)
+        self.dirs = {}
+
+        # The PATH indexed, when it was last checked, and the executable
+        # names (sorted, ignoring case) with their lowercase versions;
+        # replaced at once by the background thread
+        self.indexed = (None, 0, [], [])
+
+        self.builder = None
+        self.mutex = threading.Lock()
+
+    def refresh(self):
+        """
+        Start refreshing the index in the background if the PATH changed or
+        if it is time to check the directories again
+        """
+        (path, checked, names, keys) = self.indexed
+        if path == os.environ.get('PATH', '') and time.time() - checked < self.check_interval:
+            return
+        with self.mutex:
+            if self.builder and self.builder.is_alive():
+                return
+            self.builder = threading.Thread(target=self._build, args=(os.environ.get('PATH', ''),))
+            self.builder.daemon = True
+            self.builder.start()
+
+    def lookup(self, prefix, matcher = None, job = None):
+        """
+        Return the executable names starting with the given prefix (ignoring
+        case), or matching the given (wildcard) matcher if any, sorted
+        ignoring case; while waiting for the index, check whether the given
+        CompletionJob (if any) got cancelled
+        """
+        (path, checked, names, keys) = self.indexed
+        if path != os.environ.get('PATH', ''):
+            # Nothing indexed yet or the PATH just changed, wait for the index
+            self.refresh()
+            with self.mutex:
+                builder = self.builder
+            while builder.is_alive():
+                builder.join(0.05)
+                if job:
+                    job.check()
+            (path, checked, names, keys) = self.indexed
+
+        if matcher:
+            return [name for name in names if matcher.match(name)]
+        prefix = prefix.lower()
+        first = bisect_left(keys, prefix)
+        last = first
+        while last < len(keys) and keys[last].startswith(prefix):
+            last += 1
+        return names[first : last]
+
+    def _build(self, path):
+        """List the directories in the PATH and index them (in the background thread)"""
+        dirs = {}
+        for entry in path.split(';'):
+            if not entry:
+                continue
+            dir = os.path.abspath(expand_env_vars(entry))
+            if dir in dirs:
+                continue
+            try:
+                mtime = os.stat(dir).st_mtime
+            except OSError:
+                # Cannot complete, probably not there or access denied
+                continue
+            cached = self.dirs.get(dir)
+            if cached and cached[0] == mtime:
+                dirs[dir] = cached
+                continue
+            try:
+                with os.scandir(dir) as elems:
+                    dirs[dir] = (mtime, [elem.name for elem in elems
+                                         if has_exec_extension(elem.name) and elem.is_file()])
+            except OSError:
+                pass
+        self.dirs = dirs
+
+        unique = {}
+        for (mtime, executables) in dirs.values():
+            for name in executables:
+                unique.setdefault(name, name)
+        names = sorted(unique, key=str.lower)
+        self.indexed = (path, time.time(), names, [name.lower() for name in names])
@@ -8,6 +8,8 @@ from common import parse_line, unescape, sep_tokens, sep_chars
 from common import expand_tilde, expand_env_vars
 from common import associated_application, full_executable_path, is_gui_application
 from completion import complete_file, complete_wildcard, complete_result_map, complete_env_var, find_common_prefix, has_wildcards, wildcard_to_regex
+from completion import path_index
+from CompletionJob import CompletionJob
 from InputState import ActionCode, InputState
 from DirHistory import DirHistory
 import console
@@ -21,9 +23,11 @@ from pycmd_public import color, appearance, behavior
 from common import apply_settings, sanitize_settings
 
 import command_cc
+import command_history
 
 import string
-import datetime
+from HistoryFile import HistoryFile, BinaryHistoryFile, convert_history_file
+from HistoryWriter import HistoryWriter
 
 import PyCmdUtils
 import WindowSwitch, pathlib
@@ -32,11 +36,15 @@ pycmd_data_dir = None
 pycmd_install_dir = None
 state = None
 dir_hist = None
+history_file = None
+dir_history_file = None
+history_writer = None
 tmpfile = None
 resultMapFilePath = None
 create_result_map = True
 cmdLineFilePath = None
-max_cmd_history_lines = 10000
+last_exit_code = None
+last_duration = None
 git_prompt_cd = ''
 
 char2int = {'0':0, '1':1, '2':2, '3':3, '4':4, '5':5, '6':6, '7':7, '8':8, '9':9}
@@ -64,13 +72,19 @@ def init():
     global state
     state = InputState()
 
-    # Read/initialize command history
-    state.history.list = read_history(pycmd_data_dir + '\\history')
+    # Save the history files in the background
+    global history_writer
+    history_writer = HistoryWriter()
+
+    # Index the executables in the PATH in the background
+    path_index.refresh()
 
     # Read/initialize directory history
     global dir_hist
     dir_hist = DirHistory()
-    dir_hist.locations = read_history(pycmd_data_dir + '\\dir_history')
+    global dir_history_file
+    dir_history_file = HistoryFile(pycmd_data_dir + '\\dir_history', dir_hist.max_len)
+    dir_hist.locations = [line for (line, meta) in dir_history_file.read()]
     dir_hist.index = len(dir_hist.locations) - 1
     dir_hist.visit_cwd()
 
@@ -99,6 +113,10 @@ def init():
     signal.signal(signal.SIGINT, signal_handler)
 
 def deinit():
+    # Make sure the last commands make it to the history files
+    history_writer.flush()
+    print_history_warnings()
+
     os.remove(tmpfile)
     os.remove(cmdLineFilePath)
 
@@ -125,12 +143,14 @@ def main():
         if switch in ['/K', '-K']:
             # Run the specified command and continue
             if rest != []:
+                open_history()
                 run_command(rest)
                 dir_hist.visit_cwd()
                 break
         elif switch in ['/C', '-C']:
             # Run the specified command end exit
             if rest != []:
+                open_history()
                 run_command(rest)
             internal_exit()
         elif switch in ['/H', '/?', '-H']:
@@ -167,6 +187,11 @@ def main():
             internal_exit()
         arg += 1
 
+    # Read/initialize command history (in the configured format), unless
+    # done already to run a command
+    if history_file is None:
+        open_history()
+
     if title_prefix == "" :
         title_prefix = console.get_console_title()
         # TODO: fix python.exe path exposed in Python3
@@ -211,7 +236,13 @@ def main():
         dir_hist.shown = False
         debug_run = False
         no_history_update = False
+        run_dir = os.getcwd()
+
+        # Pick up the commands run by the other PyCmd instances meanwhile
+        # (as fetched in the background by the history writer)
+        state.history.merge(history_writer.tail(history_file))
         if no_new_prompt == False:
+            print_history_warnings()
             stdout.write('\n')
         else:
             no_new_prompt = False
@@ -481,9 +512,7 @@ def main():
                         if changed:
                             state.prev_prompt = state.prompt
                             state.prompt = appearance.prompt()
-                        save_history(dir_hist.locations,
-                                     pycmd_data_dir + '\\dir_history',
-                                     dir_hist.max_len)
+                        save_dir_history()
                         if dir_hist.shown:
                             dir_hist.display()
                             stdout.write(state.prev_prompt)
@@ -573,9 +602,7 @@ def main():
                             if changed:
                                 state.prev_prompt = state.prompt
                                 state.prompt = appearance.prompt()
-                            save_history(dir_hist.locations,
-                                         pycmd_data_dir + '\\dir_history',
-                                         dir_hist.max_len)
+                            save_dir_history()
                             if dir_hist.shown:
                                 dir_hist.display()
                                 stdout.write(state.prev_prompt)
@@ -601,9 +628,6 @@ def main():
                         scrolling = False
                     else:
                         state.handle(ActionCode.ACTION_ESCAPE)
-                        save_history(state.history.list,
-                                     pycmd_data_dir + '\\history',
-                                     max_cmd_history_lines)
                         auto_select = False
                 elif rec.Char == '\t':                  # Tab
                     stdout.write(state.after_cursor)        # Move cursor to the end
@@ -700,10 +724,15 @@ def main():
 
                     elif tokens[-1].strip('"').count('%') % 2 == 1:
                         (completed, suggestions) = complete_env_var(state.before_cursor)
-                    elif has_wildcards(tokens[-1]):
-                        (completed, suggestions)  = complete_wildcard(state.before_cursor)
                     else:
-                        (completed, suggestions)  = complete_file(state.before_cursor)
+                        # Listing large or remote directories can take a
+                        # while, any key cancels the completion
+                        completion = complete_in_background(complete_wildcard if has_wildcards(tokens[-1])
+                                                            else complete_file,
+                                                            state.before_cursor)
+                        if completion is None:
+                            continue
+                        (completed, suggestions) = completion
 
                     # Show multiple completions if available
                     if len(suggestions) > 1:
@@ -744,6 +773,17 @@ def main():
                         num_col_could_choose = (num_col_could_choose + num_lines - 1) / num_lines
                             
                         
+                        # The matched parts are highlighted the same way in every
+                        # suggestion, find them out once
+                        wildcard_suggestions = has_wildcards(tokens[-1])
+                        if wildcard_suggestions:
+                            tokens = parse_line(completed.rstrip('\\'))
+                            token = tokens[-1].replace('"', '')
+                            (_, _, prefix) = token.rpartition('\\')
+                            matcher = wildcard_to_regex(prefix + '*')
+                        else:
+                            common_prefix_len = len(find_common_prefix(state.before_cursor, suggestions))
+
                         for line in range(0, int(num_lines)):
                             # Print one line
                             stdout.write('\r')
@@ -762,12 +802,9 @@ def main():
                                     
                                     stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + suggestion_prefix)
                                     
-                                    if has_wildcards(tokens[-1]):
+                                    if wildcard_suggestions:
                                         # Print wildcard matches in a different color
-                                        tokens = parse_line(completed.rstrip('\\'))
-                                        token = tokens[-1].replace('"', '')
-                                        (_, _, prefix) = token.rpartition('\\')
-                                        match = wildcard_to_regex(prefix + '*').match(s)
+                                        match = matcher.match(s)
                                         current_index = 0
                                         for i in range(1, match.lastindex + 1):
                                             stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT +
@@ -779,7 +816,6 @@ def main():
                                         stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + ' ' * (column_width - len(s)))
                                     else:
                                         # Print the common part in a different color
-                                        common_prefix_len = len(find_common_prefix(state.before_cursor, suggestions))
                                         stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT +
                                                      appearance.colors.completion_match +
                                                      s[:common_prefix_len] +
@@ -1018,17 +1054,13 @@ def main():
 
         if not no_history_update:
             # Add to history
-            state.history.add(line)
-            save_history(state.history.list,
-                         pycmd_data_dir + '\\history',
-                         max_cmd_history_lines)
+            state.history.add(line, last_exit_code, run_dir, last_duration)
+            save_history()
 
 
             # Add to dir history
             dir_hist.visit_cwd()
-            save_history(dir_hist.locations,
-                         pycmd_data_dir + '\\dir_history',
-                         dir_hist.max_len)
+            save_dir_history()
 
 consoleScriptFileName = "pycmd_script.py"
 
@@ -1113,6 +1145,42 @@ def resolve_path_case(path):
     casePath = str(pathlib.Path(path.decode('utf-8')).resolve(strict=True))
     return casePath
 
+def complete_in_background(complete, line):
+    """
+    Run a completion function in the background, showing its progress below
+    the input line if it takes a while; return the (completed line,
+    completions) pair, or None if a key was pressed in the meantime (the key
+    is then read as usual)
+    """
+    job = CompletionJob(complete, line)
+    started = time.time()
+    message = ''
+    while not job.wait(0.05):
+        if console.input_pending():
+            job.cancel()
+            break
+        if time.time() - started >= job.progress_delay:
+            # Show the matches found so far and their common prefix
+            progress = ' ' + str(len(job.matches)) + ' matches so far'
+            if job.common_prefix:
+                progress += ', all starting with ' + job.common_prefix
+            progress += ' (press any key to cancel) '
+            progress = progress[:console.get_buffer_size()[0] - 1]
+            (c_x, c_y) = get_cursor()
+            offset_from_bottom = console.get_buffer_size()[1] - c_y
+            stdout.write('\n' + progress + ' ' * (len(message) - len(progress)))
+            move_cursor(c_x, console.get_buffer_size()[1] - offset_from_bottom)
+            message = progress
+
+    if message:
+        (c_x, c_y) = get_cursor()
+        offset_from_bottom = console.get_buffer_size()[1] - c_y
+        stdout.write('\n' + ' ' * len(message))
+        move_cursor(c_x, console.get_buffer_size()[1] - offset_from_bottom)
+    if job.cancelled.is_set():
+        return None
+    return job.get()
+
 def internal_cd(args):
     """The internal CD command"""
     try:
@@ -1132,6 +1200,16 @@ def internal_cd(args):
     os.environ['CD'] = os.getcwd()
 
 
+def internal_history(args):
+    """The internal HISTORY command"""
+    try:
+        lines = command_history.run(state.history, args)
+    except ValueError as error:
+        lines = [str(error)]
+    for line in lines:
+        stdout.write(u'\n' + line)
+
+
 def internal_exit(message = ''):
     """The EXIT command, with an optional goodbye message"""
     deinit()
@@ -1143,13 +1221,18 @@ def internal_exit(message = ''):
 
 def run_command(tokens):
     """Execute a command line (treat internal and external appropriately"""
-    global git_prompt_cd
+    global git_prompt_cd, last_exit_code, last_duration
     git_prompt_cd = ''
+    last_exit_code = None
+    last_duration = None
     if tokens[0] == 'exit':
         internal_exit('Bye!')
     elif tokens[0].lower() == 'cd' and [t for t in tokens if t in sep_tokens] == []:
         # This is a single CD command -- use our custom, more handy CD
         internal_cd([unescape(t) for t in tokens[1:]])
+    elif tokens[0].lower() == 'history' and [t for t in tokens if t in sep_tokens] == []:
+        # Query the command history
+        internal_history([unescape(t) for t in tokens[1:]])
     else:
         WindowSwitch.update_window_state('', ' '.join(tokens))
         if set(sep_tokens).intersection(tokens) == set([]):
@@ -1188,8 +1271,9 @@ def run_command(tokens):
         # Regular (external) command
         start_time = time.time()
         run_in_cmd(tokens)
+        last_duration = time.time() - start_time
         console_window = ctypes.windll.kernel32.GetConsoleWindow()
-        if ctypes.windll.user32.GetForegroundWindow() != console_window and time.time() - start_time > 15:
+        if ctypes.windll.user32.GetForegroundWindow() != console_window and last_duration > 15:
             # If the window is inactive, flash after long tasks
             flashwinfo = console.USER32_FLASHWINFO()
             flashwinfo.Size = ctypes.sizeof(console.USER32_FLASHWINFO)
@@ -1200,6 +1284,7 @@ def run_command(tokens):
             ctypes.windll.user32.FlashWindowEx(ctypes.byref(flashwinfo))
 
 def run_in_cmd(tokens):
+    global last_exit_code
     pseudo_vars = ['CD', 'DATE', 'ERRORLEVEL', 'RANDOM', 'TIME']
 
     expand_env = False if tokens[0] == 'sd' else True
@@ -1236,9 +1321,14 @@ def run_in_cmd(tokens):
     if line_sanitized != '':
         command = u'"'
         command += line_sanitized
-        command += u' &set > "' + tmpfile + u'"'
+        # cmd expands %VAR% when it parses the whole line, i.e. before the
+        # command runs; the exit code is expanded late by call (the caret
+        # hides it from the first expansion), right after the command
+        command += u' & call echo ERRORLEVEL=%^ERRORLEVEL%>"' + tmpfile + u'"'
+        command += u' &set >> "' + tmpfile + u'"'
         for var in pseudo_vars:
-            command += u' & echo ' + var + u'="%' + var + u'%" >> "' + tmpfile + '"'
+            if var != 'ERRORLEVEL':
+                command += u' & echo ' + var + u'="%' + var + u'%" >> "' + tmpfile + '"'
         command += u'& <nul (set /p xxx=CD=) >>"' + tmpfile + u'" & cd >>"' + tmpfile + '"'
         command += u'"'
         os.system(command) #.encode(sys.getfilesystemencoding()))
@@ -1253,6 +1343,8 @@ def run_in_cmd(tokens):
             value = value.strip('"')
         new_environ[variable] = value
     env_file.close()
+    if new_environ.get('ERRORLEVEL', '').lstrip('-').isdigit():
+        last_exit_code = int(new_environ['ERRORLEVEL'])
     if new_environ != {}:
         for variable in os.environ.keys():
             if not variable in new_environ.keys() \
@@ -1263,6 +1355,9 @@ def run_in_cmd(tokens):
     cd = os.environ['CD'] # .decode(stdout.encoding)
     os.chdir(cd.encode(sys.getfilesystemencoding()))
 
+    # The command may have changed the PATH or installed executables
+    path_index.refresh()
+
 
 def signal_handler(signum, frame):
     """
@@ -1273,76 +1368,57 @@ def signal_handler(signum, frame):
         # Emulate a Ctrl-C press
         write_input(67, 0x0008)
 
-def append_tail_datetime(line):
-    return line + datetime.datetime.now().strftime("[%Y/%m/%d %I:%M:%S%p %A]")
-
-def remove_tail_datetime(line):
-    # empty line slips in by crashing pycmd?
-    if len(line) == 0:
-        return ''
-    if line[-1] == u']':
-        i = len(line) - 4
-        if i > 0 and line[i] == u'd' and line[i+1] == u'a' and line[i+2] == u'y':
-            i -= 26
-            for j in range(4):
-                k = i - j
-                if k > 0:
-                    if line[k] == u'[':
-                        return line[:k]
-                else:
-                    break;
-    # no tail datetime found
-    return line
-
-def save_history(lines, filename, length):
+def open_history():
     """
-    Save a list of unique lines into a history file and truncate the
-    result to the given maximum number of lines
+    Apply the history settings, open the command history file in the
+    configured format (converting it from the other format if that one is
+    more recent) and start loading it; this happens in the background so
+    that the prompt shows up right away even for a long history
     """
-    if os.path.isfile(filename):
-        # Read previously saved history and merge with current
-        with open(filename, 'r', encoding='utf-8', errors='replace') as history_file:
-            history_to_save = [line.rstrip(u'\n') for line in history_file.readlines()]
-        # For performance and correctness of merging history from multiple instances,
-        # only save the last command, this is good because save_history is called after
-        # each command
-        if len(history_to_save) > 0 and lines[-1] == remove_tail_datetime(history_to_save[-1]):
-            # no update
-            return
-
-        # assume duplicated could happen at most once
-        for histI in range(len(history_to_save)-2, -1, -1):
-            if remove_tail_datetime(history_to_save[histI]) == lines[-1]:
-                del history_to_save[histI]
-                break
-        history_to_save.append(append_tail_datetime(lines[-1]))
-        # for line in lines:
-        #     if line in history_to_save:
-        #         history_to_save.remove(line)
-        #     history_to_save.append(line)
+    # Order the history search results as configured
+    state.history.ranking_mode = behavior.history_ranking
+    state.history.dir_first = behavior.history_dir_first
+
+    global history_file
+    text_file = HistoryFile(pycmd_data_dir + '\\history',
+                            behavior.history_max_lines, behavior.history_keep_days)
+    binary_file = BinaryHistoryFile(pycmd_data_dir + '\\history.bin',
+                                    behavior.history_max_lines, behavior.history_keep_days)
+    if behavior.history_format == 'binary':
+        (history_file, other_file) = (binary_file, text_file)
     else:
-        # No previous history, save current
-        history_to_save = lines
+        (history_file, other_file) = (text_file, binary_file)
+    if os.path.isfile(other_file.filename) and (not os.path.isfile(history_file.filename)
+                                                or (os.path.getmtime(other_file.filename)
+                                                    > os.path.getmtime(history_file.filename))):
+        convert_history_file(other_file, history_file)
+    state.history.load_in_background(history_file.read(newest_first=True, every_run=True))
 
-    if len(history_to_save) > length:
-        history_to_save = history_to_save[-length :]    # Limit history file
 
-    # Write merged history to history file
-    with open(filename, 'w', encoding='utf-8', newline='\n') as history_file:
-        history_file.writelines([line + u'\n' for line in history_to_save])
+def save_history():
+    """Record the last command (and its metadata) in the history file, in the background"""
+    if len(state.history.list) > 0:
+        line = state.history.list[-1]
+        history_writer.append(history_file, line, state.history.meta(line))
 
 
-def read_history(filename):
+def print_history_warnings():
     """
-    Read and return a list of lines from a history file
+    Print the warnings about the history files, which may come from the
+    background threads (so they are only printed before a new prompt)
     """
-    if os.path.isfile(filename):
-        with open(filename, 'r', encoding='utf-8', errors='replace') as history_file:
-            history = [remove_tail_datetime(line.rstrip(u'\n\r')) for line in history_file.readlines()]
-    else:
-        print('Warning: Can\'t open ' + os.path.basename(filename) + '!')
-        history = []
-    return history
+    warnings = history_writer.pop_warnings()
+    for file in [history_file, dir_history_file]:
+        if file is not None:
+            warnings += file.pop_warnings()
+    for warning in warnings:
+        stdout.write('\n' + warning)
+
+
+def save_dir_history():
+    """Record the current location in the directory history file, in the background"""
+    if dir_hist.locations:
+        history_writer.append(dir_history_file, dir_hist.locations[-1])
 
 
 def print_usage():
@@ -1367,6 +1443,9 @@ if __name__ == '__main__':
         init()
         main()
     except Exception as e:        
+        if history_writer:
+            # Save the last commands anyway
+            history_writer.flush()
         report_file_name = (pycmd_data_dir
                             + '\\crash-' 
                             + time.strftime('%Y%m%d_%H%M%S') 
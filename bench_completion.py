@@ -0,0 +1,58 @@
+#
+# Benchmark for assembling the completions of command names
+#
+# Usage:
+#    python bench_completion.py [-r repeat] [number of candidates ...]
+#
+# Generates synthetic executables (many of them sharing a name with another
+# executable or with a file) and times complete_command_names on them (1k,
+# 10k and 100k candidates by default). The time per candidate should stay
+# about the same as the number of candidates grows.
+#
+# This runs without the Windows console (see bench_input.py).
+#
+import sys, time, random, getopt
+import bench_input
+
+# Extensions of the synthetic executables and files
+exec_extensions = ['.exe', '.bat', '.cmd', '.com']
+file_extensions = ['', '.txt', '.py', '\\']
+
+def generate_candidates(size, seed = 0):
+    """
+    Return synthetic (executables, files) completions with the given total
+    number of candidates, the executables sorted like the PATH index does
+    """
+    rand = random.Random(seed)
+    names = [''.join([rand.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rand.randint(3, 10))])
+             for i in range(size // 2)]
+    executables = set()
+    while len(executables) < size - size // 4:
+        executables.add(rand.choice(names) + rand.choice(exec_extensions))
+    files = set()
+    while len(files) < size // 4:
+        files.add(rand.choice(names) + rand.choice(file_extensions))
+    return (sorted(executables, key=str.lower), list(files))
+
+def main(sizes, repeat):
+    bench_input.stub_windows_modules()
+    from completion import complete_command_names, wildcard_to_regex
+    matcher = wildcard_to_regex('*')
+    print('%10s %12s %20s' % ('candidates', 'time (ms)', 'per candidate (us)'))
+    for size in sizes:
+        (executables, files) = generate_candidates(size)
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            complete_command_names('', matcher, files, executables)
+            times.append(time.perf_counter() - start)
+        elapsed = sorted(times)[len(times) // 2]
+        print('%10d %12.3f %20.3f' % (size, elapsed * 1000, elapsed / size * 1000000))
+
+if __name__ == '__main__':
+    (options, args) = getopt.getopt(sys.argv[1:], 'r:')
+    repeat = 5
+    for (option, value) in options:
+        if option == '-r':
+            repeat = int(value)
+    main([int(arg) for arg in args] or [1000, 10000, 100000], repeat)
@@ -0,0 +1,97 @@
+#
+# Benchmark for the command history search
+#
+# Usage:
+#    python bench_history.py [number of lines ...]
+#
+# Generates synthetic command histories of the given sizes (10k, 100k and 1M
+# lines by default) and compares the history search with and without the
+# trigram index.
+#
+import sys, time, random
+from CommandHistory import CommandHistory
+
+# Words used to generate the synthetic commands
+vocabulary = ['git', 'checkout', 'status', 'commit', 'push', 'pull', 'rebase', 'log',
+              'diff', 'master', 'origin', 'cmake', 'ninja', 'build', 'msbuild', 'python',
+              'pip', 'install', 'setup.py', 'cd', 'dir', 'copy', 'del', 'echo', 'type',
+              'findstr', 'devenv', 'test', 'release', 'debug', '..', '-m', '-C', '/s',
+              'src\\core', 'src\\ui', 'out\\debug', 'out\\release', 'README.md']
+
+# Filters searched for in the benchmark
+filters = ['g', 'git', 'git c', 'g c m', 'cmake build', 'py set inst', 'findstr x1',
+           'out\\debug', 'ninja -C out', 'zzz']
+
+def generate_vocabulary(size, seed = 0):
+    """
+    Return a vocabulary of the given size: the default words, followed by
+    made up ones if more are needed
+    """
+    rand = random.Random(seed)
+    words = vocabulary[:size]
+    while len(words) < size:
+        words.append(''.join([rand.choice('abcdefghijklmnopqrstuvwxyz')
+                              for i in range(rand.randint(2, 10))]))
+    return words
+
+def generate_history(size, seed = 0, vocabulary = vocabulary):
+    """Generate a synthetic command history with the given number of lines"""
+    rand = random.Random(seed)
+    history = []
+    for i in range(size):
+        words = [rand.choice(vocabulary) for j in range(rand.randint(1, 5))]
+        if rand.random() < 0.5:
+            # Some unique-ish arguments, like file names or commit hashes
+            words.append('%s%x' % (rand.choice(['', 'x', 'file_', 'v']), rand.getrandbits(24)))
+        history.append(' '.join(words))
+    return history
+
+def time_search(history, filter, repeat = 5, depth = 30):
+    """
+    Return the best time (in seconds) for searching the history and
+    navigating through the first few matches
+    """
+    best = None
+    for i in range(repeat):
+        history.searches = None
+        history.reset()
+        start = time.perf_counter()
+        history.start(filter)
+        for j in range(depth):
+            history.up()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(sizes):
+    for size in sizes:
+        lines = generate_history(size)
+        print('%d lines' % size)
+
+        linear = CommandHistory()
+        linear.index = None
+        linear.load(lines)
+
+        indexed = CommandHistory()
+        start = time.perf_counter()
+        indexed.load(lines)
+        build_time = time.perf_counter() - start
+        store = indexed.list
+        print('  store: %d unique lines, %.1f MB' % (len(store),
+              (len(store.arena) + store.offsets.itemsize * len(store.offsets)
+               + store.lengths.itemsize * len(store.lengths)) / 1048576.0))
+        stats = indexed.index.stats()
+        print('  index: built in %.2fs, %d trigrams (%d too common), %d entries, %.1f MB'
+              % (build_time, stats['trigrams'], stats['saturated'], stats['entries'],
+                 stats['memory'] / 1048576.0))
+
+        print('  %-16s %12s %12s' % ('filter', 'linear (ms)', 'indexed (ms)'))
+        for filter in filters:
+            print('  %-16s %12.2f %12.2f' % (repr(filter),
+                                             time_search(linear, filter) * 1000,
+                                             time_search(indexed, filter) * 1000))
+        print()
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
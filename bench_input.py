@@ -0,0 +1,158 @@
+#
+# Benchmark for the per-keystroke latency of the input line
+#
+# Usage:
+#    python bench_input.py [-s size ...] [-v vocabulary size] [-k keys file] [-r repeat]
+#
+# Generates synthetic command histories (see bench_history.py), replays
+# keystroke sequences through InputState.handle and reports the median (p50)
+# and 99th percentile (p99) latency of each kind of key.
+#
+# The keys file holds one sequence per line. Characters are typed as is and
+# special keys are written in braces:
+#    {up} {down} {left} {right} {home} {end} {bs} {del} {esc} {expand} {enter}
+# where {expand} is Alt-/ and {enter} adds the line to the history, like
+# running it would. Lines starting with # are ignored.
+#
+# This runs without the Windows console: outside of Windows, the modules
+# that need it (console, PyCmdUtils, winreg, ctypes.windll and
+# sys.getwindowsversion) are stubbed.
+#
+import sys, io, time, types, ctypes, getopt, contextlib
+import bench_history
+
+# Keystroke sequences replayed by default
+default_keys = ['git c{up}{up}{up}{down}{esc}',
+                'g c m{up}{up}{up}{up}{esc}',
+                'cmake build{up}{up}{bs}{bs}{up}{up}{enter}',
+                'py set inst{up}{esc}',
+                'ninja -C out{up}{up}{up}{enter}',
+                'git checkout {expand}{expand}{expand}{enter}',
+                'findstr x1{up}{esc}',
+                '{up}{up}{up}{up}{up}{down}{down}{esc}',
+                'out\\de{expand}{expand}{home}{end}{left}{right}{del}{esc}']
+
+class Stub(types.ModuleType):
+    """A module (or object) whose attributes and calls all return stubs"""
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub(name)
+
+    def __call__(self, *args, **kwargs):
+        return 0
+
+def stub_windows_modules():
+    """Stub the Windows-only modules, so that InputState can be imported"""
+    if sys.platform == 'win32':
+        return
+    for name in ['console', 'PyCmdUtils', 'winreg']:
+        sys.modules[name] = Stub(name)
+    ctypes.windll = Stub('windll')
+    sys.getwindowsversion = lambda: (10, 0, 0, 2, '')
+
+def parse_keys(sequence):
+    """Split a keystroke sequence into a list of keys"""
+    keys = []
+    pos = 0
+    while pos < len(sequence):
+        end = sequence.find('}', pos) if sequence[pos] == '{' else -1
+        if end > pos:
+            keys.append(sequence[pos : end + 1])
+            pos = end + 1
+        else:
+            keys.append(sequence[pos])
+            pos += 1
+    return keys
+
+def press(state, key):
+    """Replay a key on the input state, the way PyCmd.main would handle it"""
+    from InputState import ActionCode
+    if key == '{enter}':
+        state.history.add(state.before_cursor + state.after_cursor)
+        state.reset_line('')
+    elif key == '{up}':
+        state.handle(ActionCode.ACTION_PREV)
+    elif key == '{down}':
+        state.handle(ActionCode.ACTION_NEXT)
+    elif key == '{left}':
+        state.handle(ActionCode.ACTION_LEFT, False)
+    elif key == '{right}':
+        state.handle(ActionCode.ACTION_RIGHT, False)
+    elif key == '{home}':
+        state.handle(ActionCode.ACTION_HOME, False)
+    elif key == '{end}':
+        state.handle(ActionCode.ACTION_END, False)
+    elif key == '{bs}':
+        state.handle(ActionCode.ACTION_BACKSPACE)
+    elif key == '{del}':
+        state.handle(ActionCode.ACTION_DELETE)
+    elif key == '{esc}':
+        state.handle(ActionCode.ACTION_ESCAPE)
+    elif key == '{expand}':
+        state.handle(ActionCode.ACTION_EXPAND)
+    else:
+        state.handle(ActionCode.ACTION_INSERT, key)
+
+def percentile(values, fraction):
+    """Return a percentile of a sorted list of values"""
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def replay(history, sequences, repeat):
+    """
+    Replay the keystroke sequences on a fresh input state with the given
+    history; return the latencies (in seconds), by kind of key
+    """
+    from InputState import InputState
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Silence the warnings about the environment
+        state = InputState()
+    state.history.load(history)
+    state.reset_line('')
+    latencies = {}
+    for i in range(repeat):
+        for sequence in sequences:
+            for key in parse_keys(sequence):
+                start = time.perf_counter()
+                press(state, key)
+                elapsed = time.perf_counter() - start
+                kind = key if key.startswith('{') else 'char'
+                latencies.setdefault(kind, []).append(elapsed)
+            state.reset_line('')
+    return latencies
+
+def main(sizes, vocabulary_size, sequences, repeat):
+    stub_windows_modules()
+    vocabulary = bench_history.generate_vocabulary(vocabulary_size)
+    for size in sizes:
+        history = bench_history.generate_history(size, vocabulary=vocabulary)
+        print('%d lines, %d words' % (size, len(vocabulary)))
+        latencies = replay(history, sequences, repeat)
+        latencies['all'] = sum(latencies.values(), [])
+        print('  %-10s %8s %10s %10s %10s' % ('key', 'count', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+        for kind in sorted(latencies, key=lambda kind: (kind == 'all', kind)):
+            values = sorted(latencies[kind])
+            print('  %-10s %8d %10.3f %10.3f %10.3f' % (kind, len(values),
+                                                      percentile(values, 0.5) * 1000,
+                                                      percentile(values, 0.99) * 1000,
+                                                      values[-1] * 1000))
+        print()
+
+if __name__ == '__main__':
+    (options, args) = getopt.getopt(sys.argv[1:], 's:v:k:r:')
+    sizes = []
+    vocabulary_size = len(bench_history.vocabulary)
+    sequences = default_keys
+    repeat = 5
+    for (option, value) in options:
+        if option == '-s':
+            sizes.append(int(value))
+        elif option == '-v':
+            vocabulary_size = int(value)
+        elif option == '-k':
+            with open(value, 'r', encoding='utf-8') as keys_file:
+                sequences = [line.rstrip('\n') for line in keys_file
+                             if line.strip() and not line.startswith('#')]
+        elif option == '-r':
+            repeat = int(value)
+    main(sizes or [10000, 100000], vocabulary_size, sequences, repeat)
@@ -0,0 +1,102 @@
+#
+# The built-in HISTORY command: query the command history by time
+#
+import re, time, datetime
+from HistoryStore import no_exit_code
+
+usage = ['Usage: history [count]                         the last commands run (20 by default)',
+         '       history <from> [<to>]                   the commands last run in a time range',
+         '       history --top [count] [<from> [<to>]]   the commands run most often (10 by default)',
+         '                                               this week (or in a time range)',
+         '       history --slow [count] [<from> [<to>]]  the slowest commands (10 by default),',
+         '                                               as of their last run',
+         '',
+         'Times can be given as now, today, yesterday, week (since Monday), month,',
+         'a duration ago (30m, 2h, 3d, 1w), a date (2024-01-31), a time of today',
+         '(13:45) or both (2024-01-31T13:45).']
+
+# Time formats accepted for the bounds of a range
+time_formats = ['%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S']
+
+# Units of the relative times, in seconds
+time_units = {'m': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+
+def run(history, args):
+    """Run the HISTORY command on a CommandHistory; return the lines to print"""
+    if args and args[0] in ['-h', '--help', '/?']:
+        return usage
+    view = args[0] if args and args[0] in ['--top', '--slow'] else None
+    if view:
+        args = args[1:]
+    count = 10 if view else 20
+    if args and args[0].isdigit():
+        count = int(args[0])
+        args = args[1:]
+    if len(args) > 2:
+        raise ValueError('Too many arguments to history (see history --help)')
+
+    now = time.time()
+    bounds = [parse_time(arg, now) for arg in args]
+    if view == '--top' and not bounds:
+        bounds = [parse_time('week', now)]
+    (start, end) = (bounds + [None, None])[:2]
+
+    # The history may still be loading in the background
+    history.swap_loaded(wait=True)
+    store = history.list
+    if view == '--top':
+        return ['%6d  %s' % (runs, store.line(id))
+                for (runs, id) in history.timeline.top(count, start, end)]
+    elif view == '--slow':
+        return [format_duration(store.durations[id]) + '  ' + format_exit_code(store.exit_codes[id])
+                + '  ' + store.line(id)
+                for id in history.timeline.slowest(count, start, end)]
+    if bounds:
+        ids = history.timeline.between(start, end)
+    else:
+        ids = reversed(history.timeline.latest(count))
+    return [format_time(store.times[id]) + '  ' + store.line(id) for id in ids]
+
+def parse_time(spec, now):
+    """Parse a time given to the HISTORY command into seconds since the epoch"""
+    today = datetime.datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    if spec == 'now':
+        return now
+    elif spec == 'today':
+        return time.mktime(today.timetuple())
+    elif spec == 'yesterday':
+        return time.mktime((today - datetime.timedelta(days=1)).timetuple())
+    elif spec == 'week':
+        return time.mktime((today - datetime.timedelta(days=today.weekday())).timetuple())
+    elif spec == 'month':
+        return time.mktime(today.replace(day=1).timetuple())
+
+    relative = re.match(r'^(\d+)([mhdw])$', spec)
+    if relative:
+        return now - int(relative.group(1)) * time_units[relative.group(2)]
+    if re.match(r'^\d\d?:\d\d$', spec):
+        spec = today.strftime('%Y-%m-%dT') + spec
+    for time_format in time_formats:
+        try:
+            return time.mktime(datetime.datetime.strptime(spec, time_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('Invalid time "' + spec + '" (see history --help)')
+
+def format_duration(duration):
+    """Format the duration of a command (in seconds) for listing"""
+    if duration < 60:
+        return '%9.3fs' % duration
+    (minutes, seconds) = divmod(int(duration), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '%3dh %02dm %02ds' % (hours, minutes, seconds) if hours else '%6dm %02ds' % (minutes, seconds)
+
+def format_exit_code(exit_code):
+    """Format the exit code of a command (if known) for listing"""
+    return '   ' if exit_code == no_exit_code else '%3d' % exit_code
+
+def format_time(stamp):
+    """Format the time a command was run (if known) for listing"""
+    if not stamp:
+        return ' ' * 16
+    return datetime.datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M')
@@ -2,8 +2,8 @@
 # Common utility functions
 #
 import os, string, fsm, winreg, pefile, mmap, sys, traceback
-import re
 import pycmd_public
+from FuzzyMatcher import FuzzyMatcher
 
 
 # Stop points when navigating one word at a time
@@ -197,12 +197,8 @@ def fuzzy_match(substr, str, prefix_only = False):
     word boundaries in str.
     """
     #print '\n\nMatch "' + substr + '" in "' + str + '"\n\n'
-    words = substr.split(' ')
-    pattern = [('\\b' if prefix_only else '') + '(' + word + ').*' for word in words]
-    # print '\n\n', pattern, '\n\n'
-    pattern = ''.join(pattern)
-    matches = re.search(pattern, str, re.IGNORECASE)
-    return [matches.span(i) for i in range(1, len(words) + 1)] if matches else []
+    matches = FuzzyMatcher(substr.split(' '), prefix_only).match(str)
+    return matches[1] if matches else []
 
 def abbrev_string(string):
     """Abbreviate a string by keeping uppercase and non-alphabetical characters"""
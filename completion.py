@@ -4,12 +4,36 @@
 #    2) names of environment variables
 #
 
-import sys, os, re
+import sys, os, re, functools
+from collections import Counter
 from common import parse_line, expand_env_vars, has_exec_extension, strip_extension
 from common import contains_special_char, starts_with_special_char
 from common import sep_chars, seq_tokens
-
-def complete_file(line):
+from PathIndex import PathIndex
+from DirCache import DirCache
+
+# The executables in the PATH, for completing command names
+path_index = PathIndex()
+
+# The directories listed for completing file names
+dir_cache = DirCache()
+
+# The commands built into cmd.exe
+internal_commands = ['assoc',
+                     'call', 'cd', 'chdir', 'cls', 'color', 'copy',
+                     'date', 'del', 'dir',
+                     'echo', 'endlocal', 'erase', 'exit',
+                     'for', 'ftype',
+                     'goto',
+                     'if',
+                     'md', 'mkdir', 'move',
+                     'path', 'pause', 'popd', 'prompt', 'pushd',
+                     'rem', 'ren', 'rename', 'rd', 'rmdir',
+                     'set', 'setlocal', 'shift', 'start',
+                     'time', 'title', 'type',
+                     'ver', 'verify', 'vol']
+
+def complete_file(line, job = None):
     """
     Complete names of files and/or directories
 
@@ -25,15 +49,18 @@ def complete_file(line):
       The return value is a tuple containing 
        a) the updated line (includes the completed suffix and quotes if needed) 
        b) and a list of possible subsequent completions
+
+      When running as a CompletionJob, the job is passed along to report
+      the matches as they are found and to stop once cancelled.
     """
-    (completed, completions) = complete_file_simple(line)
+    (completed, completions) = complete_file_simple(line, job)
     if completed == line and completions == []:
         # Try the alternate completion
-        (completed, completions) = complete_file_alternate(line)
+        (completed, completions) = complete_file_alternate(line, job)
 
     return (completed, completions)
 
-def complete_file_simple(line):
+def complete_file_simple(line, job = None):
     """
     Complete names of files or directories
     This function tokenizes the line and computes file and directory
@@ -65,76 +92,15 @@ def complete_file_simple(line):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) 
-                           if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-        
-
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + '\\' for elem in completions if os.path.isdir(dir_to_complete + '\\' + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + '\\' + elem)]
+    (completions_dirs, completions_files) = dir_cache.matches(dir_to_complete, matcher, job)
+    completions_dirs = [elem + '\\' for elem in completions_dirs]
     completions = completions_dirs + completions_files
 
     if (len(tokens) == 1 or tokens[-2] in seq_tokens) and path_to_complete == '':
         # We are at the beginning of a command ==> also complete from the path
-        completions_path = []
-        for elem_in_path in os.environ['PATH'].split(';'):
-            dir_to_complete = expand_env_vars(elem_in_path) + '\\'
-            try:                
-                completions_path += [elem for elem in os.listdir(dir_to_complete) 
-                                     if matcher.match(elem)
-                                     and os.path.isfile(dir_to_complete + '\\' + elem)
-                                     and has_exec_extension(elem)
-                                     and not elem in completions
-                                     and not elem in completions_path]
-            except OSError:
-                # Cannot complete, probably access denied
-                pass
-
-        # Add internal commands
-        internal_commands = ['assoc',
-                             'call', 'cd', 'chdir', 'cls', 'color', 'copy',
-                             'date', 'del', 'dir',
-                             'echo', 'endlocal', 'erase', 'exit',
-                             'for', 'ftype',
-                             'goto',
-                             'if',
-                             'md', 'mkdir', 'move',
-                             'path', 'pause', 'popd', 'prompt', 'pushd',
-                             'rem', 'ren', 'rename', 'rd', 'rmdir',
-                             'set', 'setlocal', 'shift', 'start',
-                             'time', 'title', 'type',
-                             'ver', 'verify', 'vol']
-        if sys.getwindowsversion()[0] >= 6:
-            # Windows 7 or newer
-            internal_commands.append('mklink')
-        completions_path += [elem for elem in internal_commands
-                             if matcher.match(elem)
-                             and not elem in completions
-                             and not elem in completions_path]
-
-
-        # Sort in lexical order (case ignored)
-        completions_path.sort(key=str.lower)
-
-        # Remove .com, .exe or .bat extension where possible
-        completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
-        completions_path_nice = []
-        for i in range(0, len(completions_path_no_ext)):
-            similar = [elem for elem in completions_path_no_ext if elem == completions_path_no_ext[i]]
-            similar += [elem for elem in completions if strip_extension(elem) == completions_path_no_ext[i]]
-            if len(similar) == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
-                # No similar executables, don't use extension
-                completions_path_nice.append(completions_path_no_ext[i])
-            else:
-                # Similar executables found, keep extension
-                completions_path_nice.append(completions_path[i])
-        completions += completions_path_nice
+        executables = path_index.lookup(prefix, matcher if has_wildcards(prefix) else None, job)
+        completions += complete_command_names(prefix, matcher, completions, executables)
 
     if completions != []:
         # Find the longest common sequence
@@ -182,7 +148,44 @@ def complete_file_simple(line):
         return (line, [])
 
 
-def complete_file_alternate(line):
+def complete_command_names(prefix, matcher, completions, executables):
+    """
+    Complete the names of commands: the given executables (from the PATH)
+    and the internal commands matching the wildcard matcher, other than the
+    given file or directory completions
+
+    Returns the names sorted in lexical order (case ignored), without their
+    .com, .exe, .bat or .cmd extension unless another completion has the
+    same name otherwise.
+    """
+    # Add internal commands, de-duplicate and leave out the files completed
+    # already (keeping the first occurrence of each name)
+    names = dict.fromkeys(executables)
+    commands = internal_commands
+    if sys.getwindowsversion()[0] >= 6:
+        # Windows 7 or newer
+        commands = commands + ['mklink']
+    for elem in commands:
+        if matcher.match(elem):
+            names.setdefault(elem)
+    for elem in completions:
+        names.pop(elem, None)
+
+    # Sort in lexical order (case ignored)
+    names = sorted(names, key=str.lower)
+
+    # Remove .com, .exe or .bat extension where possible, i.e. when no other
+    # command, file or directory has the same name without extension
+    names_no_ext = [strip_extension(elem) for elem in names]
+    similar = Counter(names_no_ext)
+    similar.update(strip_extension(elem) for elem in completions)
+    return [names_no_ext[i]
+            if similar[names_no_ext[i]] == 1 and has_exec_extension(names[i]) and len(prefix) < len(names[i]) - 3
+            else names[i]
+            for i in range(len(names))]
+
+
+def complete_file_alternate(line, job = None):
     """
     Complete names of files or directories using an alternate tokenization
 
@@ -221,19 +224,9 @@ def complete_file_alternate(line):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) 
-                           if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-        
-
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + '\\' for elem in completions if os.path.isdir(dir_to_complete + '\\' + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + '\\' + elem)]
+    (completions_dirs, completions_files) = dir_cache.matches(dir_to_complete, matcher, job)
+    completions_dirs = [elem + '\\' for elem in completions_dirs]
     completions = completions_dirs + completions_files
 
     if completions != []:
@@ -269,7 +262,7 @@ def complete_file_alternate(line):
         return (line, [])
 
 
-def complete_wildcard(line):
+def complete_wildcard(line, job = None):
     """
     Complete file/dir wildcards
     This function tokenizes the line and computes file and directory
@@ -301,18 +294,9 @@ def complete_wildcard(line):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-        
-
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + '\\' for elem in completions if os.path.isdir(dir_to_complete + '\\' + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + '\\' + elem)]
+    (completions_dirs, completions_files) = dir_cache.matches(dir_to_complete, matcher, job)
+    completions_dirs = [elem + '\\' for elem in completions_dirs]
     completions = completions_dirs + completions_files
 
     if completions != []:
@@ -439,29 +423,13 @@ def find_common_prefix(original, completions):
     Search for the longest common prefix in a list of strings
     Returns the longest common prefix
     """
-    common_len = 0
-    common_string = ''
-    mismatch = False
-    perfect = True
-
-    # Cache lowercase version to avoid repeated calls to str.lower()
+    # The common prefix of the smallest and the largest string (in lexical
+    # order) is the common prefix of all of them; ignoring case first, then
+    # to check whether they also agree on the case
     completions_lower = [s.lower() for s in completions]
-    common_string_lower = ''
-
-    while common_len < len(completions[0]) and not mismatch:
-        common_len += 1
-        common_string = completions[0][0:common_len]
-        common_string_lower = completions_lower[0][0:common_len]
-        for i in range(1, len(completions)):
-            completion = completions[i]
-            completion_lower = completions_lower[i]
-            if completion_lower[0:common_len] != common_string_lower:
-                mismatch = True
-            elif completion[0:common_len] != common_string:
-                perfect = False
-    if mismatch:
-        common_string = common_string[:-1]
-        common_len -= 1
+    common_len = len(os.path.commonprefix([min(completions_lower), max(completions_lower)]))
+    common_string = completions[0][:common_len]
+    perfect = len(os.path.commonprefix([min(completions), max(completions)])) >= common_len
 
     # Try to take a good guess wrt letter casing
     if not perfect:
@@ -475,10 +443,12 @@ def find_common_prefix(original, completions):
     return common_string
 
 
+@functools.lru_cache(maxsize=64)
 def wildcard_to_regex(pattern):
     """
     Transform a wildcard pattern into a compiled regex object.
     This also handles escaping as needed.    
+    The compiled regexes of the patterns last used are cached.
     """
     # Transform pattern into regexp
     translations = [('\\', '\\\\'),
@@ -174,6 +174,21 @@ def read_input():
         if numEventsWritten.value == 1 and record.EventType == KEY_EVENT and record.KeyDown:
             return record
 
+def input_pending():
+    """
+    Check (without waiting) whether a key press is waiting to be read by
+    read_input; the other input events in front of it are discarded
+    """
+    while True:
+        record = INPUT_RECORD()
+        numEventsRead = c_int()
+        ret = ctypes.windll.kernel32.PeekConsoleInputA(stdin_handle, byref(record), 1, byref(numEventsRead))
+        if not ret or numEventsRead.value != 1:
+            return False
+        if record.EventType == KEY_EVENT and record.KeyDown:
+            return True
+        ctypes.windll.kernel32.ReadConsoleInputA(stdin_handle, byref(record), 1, byref(numEventsRead))
+
 def write_input(key_code, control_state):
     """Emulate a key press with the given key code and control key mask"""
     record = INPUT_RECORD()
@@ -186,6 +186,52 @@ behavior.quiet_mode = False
 behavior.completion_mode = 'bash'
 
 
+# Change the order of the history search results
+#
+# The matches are grouped by how well they match the filter; within a group,
+# they are ordered by:
+#   'recency'  -- the most recently run commands first (the default)
+#   'frecency' -- the commands run most often and most recently first; commands
+#                 last run in the current directory are preferred, and the ones
+#                 whose last run failed are demoted
+#
+behavior.history_ranking = 'recency'
+
+
+# Show the history search results among the commands last run in the current
+# directory first, before the ones run elsewhere
+#
+# The default is True; set it to False to rank all the commands together:
+#       behavior.history_dir_first = False
+behavior.history_dir_first = True
+
+
+# Change the format of the command history file (in %APPDATA%\PyCmd)
+#
+# Supported values are:
+#   'text'   -- the "history" file, one command per line (the default)
+#   'binary' -- the "history.bin" file, which loads faster for a long history
+#
+# When switching formats, the history is converted (losslessly) from the file
+# last written to.
+behavior.history_format = 'text'
+
+
+# Change how much of the command history is kept
+#
+# Every run of a command from the last history_keep_days days is kept; older
+# runs are deduplicated, keeping only the last run of each command. Beyond
+# history_max_lines distinct commands, the older commands that were run the
+# least often and the least recently are dropped. The history file is
+# compacted in the background as it grows.
+#
+# The defaults are:
+#       behavior.history_max_lines = 10000
+#       behavior.history_keep_days = 7
+behavior.history_max_lines = 10000
+behavior.history_keep_days = 7
+
+
 # Remember, you can do whatever you want in this Python script!
 #
 # Also note that you can directly output colored text via the color
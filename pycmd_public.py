@@ -185,10 +185,49 @@ class Behavior(_Settings):
         # Select the completion mode; currently supported: 'bash'
         self.completion_mode = 'bash'
 
+        # Select how the matches of a history search are ordered (within the
+        # same match quality); currently supported:
+        #   'recency'  -- the most recently run commands first
+        #   'frecency' -- the commands run most often and most recently first,
+        #                 preferring the ones run in the current directory and
+        #                 demoting the ones that failed
+        self.history_ranking = 'recency'
+
+        # List the history search results among the commands last run in the
+        # current directory before the ones run elsewhere
+        self.history_dir_first = True
+
+        # Select the format of the command history file; currently supported:
+        #   'text'   -- one line per command, readable and editable
+        #   'binary' -- fixed-size record headers, faster to load
+        self.history_format = 'text'
+
+        # Retention of the command history: the maximum number of distinct
+        # commands kept, and the number of days during which every run of a
+        # command is kept (older runs are deduplicated)
+        self.history_max_lines = 10000
+        self.history_keep_days = 7
+
     def sanitize(self):
         if not self.completion_mode in ['bash']:
             print('Invalid setting "' + self.completion_mode + '" for "completion_mode" -- using default "bash"')
             self.completion_mode = 'bash'
+        if not self.history_ranking in ['recency', 'frecency']:
+            print('Invalid setting "' + self.history_ranking + '" for "history_ranking" -- using default "recency"')
+            self.history_ranking = 'recency'
+        if not self.history_dir_first in [True, False]:
+            print('Invalid setting "' + str(self.history_dir_first) + '" for "history_dir_first" -- using default True')
+            self.history_dir_first = True
+        self.history_dir_first = bool(self.history_dir_first)
+        if not self.history_format in ['text', 'binary']:
+            print('Invalid setting "' + self.history_format + '" for "history_format" -- using default "text"')
+            self.history_format = 'text'
+        if not isinstance(self.history_max_lines, int) or self.history_max_lines < 1:
+            print('Invalid setting "' + str(self.history_max_lines) + '" for "history_max_lines" -- using default 10000')
+            self.history_max_lines = 10000
+        if not isinstance(self.history_keep_days, (int, float)) or self.history_keep_days < 0:
+            print('Invalid setting "' + str(self.history_keep_days) + '" for "history_keep_days" -- using default 7')
+            self.history_keep_days = 7
 
 
 # Initialize global configuration instances with default values